@@ -1,8 +1,20 @@
 import os
+import sys
+import json
+import atexit
 import inspect
+import threading
 import traceback
 
-from metaflow import user_step_decorator
+from metaflow import user_step_decorator, current
+
+from failure_index import FailureIndex, signature
+
+OPENAI_ENDPOINT = "https://api.openai.com/v1/chat/completions"
+ENDPOINT = os.environ.get("AI_DEBUG_ENDPOINT", OPENAI_ENDPOINT)
+MODEL = os.environ.get("AI_DEBUG_MODEL", "gpt-4")
+# seconds a diagnosis request may take
+TIMEOUT = float(os.environ.get("AI_DEBUG_TIMEOUT", 30))
 
 PROMPT = """
 I have a Metaflow step that is defined as follows:
@@ -16,41 +28,188 @@ It raised the following exception:
 Provide suggestions how to fix it.
 """
 
+# diagnoses run in daemon threads that share one HTTP session, so a
+# failing step that will be retried re-raises right away; the last
+# attempt waits up to the request timeout for the answer
+_session = None
+
 @user_step_decorator
 def ai_debug(step_name, flow, inputs=None, attributes=None):
-    source = inspect.getsource(getattr(flow, step_name))
+    store = DiagnosisStore(current.pathspec)
+    settings = {
+        "endpoint": attributes.get("endpoint") or ENDPOINT,
+        "model": attributes.get("model") or MODEL,
+        "timeout": float(attributes.get("timeout") or TIMEOUT),
+    }
+    resent = None
+    if current.retry_count:
+        # written by the previous attempt of this task, or answered by the
+        # task that first hit the same failure
+        previous = store.get("diagnosis.md") or FailureIndex().last_diagnosis(current.pathspec)
+        if previous:
+            flow.ai_diagnosis = previous
+            print("🧠 AI diagnosis of the previous attempt is in self.ai_diagnosis")
+        else:
+            request = store.get("request.json")
+            if request:
+                # the previous attempt exited before its diagnosis arrived
+                request = json.loads(request)
+                known, claimed = FailureIndex().claim(request["sig"])
+                if known:
+                    flow.ai_diagnosis = known
+                    print("🧠 AI diagnosis of the previous attempt is in self.ai_diagnosis")
+                elif claimed:
+                    thread = diagnose(request["prompt"], store, sig=request["sig"], **settings)
+                    resent = (request["sig"], thread)
     try:
         yield
     except:
         print("❌ Step failed:")
+        exc_type, exc, tb = sys.exc_info()
         stack_trace = traceback.format_exc()
-        prompt_gpt(PROMPT.format(source=source, stack_trace=stack_trace))
+        source = inspect.getsource(getattr(flow, step_name))
+        index = FailureIndex()
+        sig = signature(exc_type, tb, source)
+        index.record(sig, exc_type, str(exc))
+        thread = None
+        if resent and resent[0] == sig:
+            # the same failure again: its request is already on its way
+            thread = resent[1]
+        else:
+            known, claimed = index.claim(sig)
+            if known:
+                print(f"🧠 Known failure [{sig}], reusing its diagnosis")
+                store.put("diagnosis.md", known)
+                show_diagnosis(known)
+            elif claimed:
+                prompt = PROMPT.format(source=source, stack_trace=stack_trace)
+                # lets the next attempt ask again if this one exits first
+                store.put("request.json", json.dumps({"prompt": prompt, "sig": sig}))
+                thread = diagnose(prompt, store, sig=sig, **settings)
+            else:
+                print(f"🧠 Failure [{sig}] is already being diagnosed by another task")
+        if thread and is_last_attempt(flow, step_name):
+            # nothing runs after this attempt to pick the answer up
+            print("🧠 Waiting for the diagnosis before failing the task..")
+            thread.join(settings["timeout"])
         raise
 
-def prompt_gpt(prompt):
-    import requests
-    OPENAI_API_KEY = os.environ.get('OPENAI_API_KEY')
-    if OPENAI_API_KEY:
-        print("🧠 Asking AI for help..")
-        url = "https://api.openai.com/v1/chat/completions"
-        headers = {
-            "Authorization": f"Bearer {OPENAI_API_KEY}",
-            "Content-Type": "application/json"
-        }
-        data = {
-            "model": "gpt-4",
-            "messages": [{"role": "user", "content": prompt}]
-        }
-        response = requests.post(url, headers=headers, json=data)
-        resp = response.json()["choices"][0]["message"]["content"]
-        markdown = f"🧠💡 AI suggestion:\n\n{resp}"
+def is_last_attempt(flow, step_name):
+    retries = 0
+    for deco in getattr(flow.__class__, step_name).decorators:
+        retries = max(retries, deco.step_task_retry_count()[0])
+    return current.retry_count >= retries
+
+def _abandon(thread, sig):
+    # the daemon thread dies with the task: let the next occurrence ask
+    if thread.is_alive():
+        FailureIndex().release(sig)
+
+class DiagnosisStore(object):
+    """
+    Diagnoses of a task, next to the flow's datastore under its pathspec,
+    which stays the same across attempts, so a retry on other compute
+    finds them too.
+    """
+
+    def __init__(self, pathspec):
+        from metaflow.metaflow_config import (
+            DEFAULT_DATASTORE,
+            DATASTORE_SYSROOT_LOCAL,
+            DATASTORE_SYSROOT_S3,
+        )
+
+        self.s3 = DEFAULT_DATASTORE == "s3"
+        if self.s3:
+            self.root = os.path.join(DATASTORE_SYSROOT_S3, "ai_debug", pathspec)
+        else:
+            root = DATASTORE_SYSROOT_LOCAL or os.path.join(os.getcwd(), ".metaflow")
+            self.root = os.path.join(root, "ai_debug", pathspec)
+
+    def put(self, name, text):
+        if self.s3:
+            from metaflow import S3
+
+            with S3(s3root=self.root) as s3:
+                s3.put(name, text)
+            return
+        os.makedirs(self.root, exist_ok=True)
+        path = os.path.join(self.root, name)
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "w") as f:
+            f.write(text)
+        os.replace(tmp, path)
+
+    def get(self, name):
+        if self.s3:
+            from metaflow import S3
+
+            with S3(s3root=self.root) as s3:
+                obj = s3.get(name, return_missing=True)
+                return obj.text if obj.exists else None
         try:
-            from rich.console import Console
-            from rich.markdown import Markdown
-            console = Console()
-            md = Markdown(markdown)
-            console.print(md)
-        except ImportError:
-            print(markdown)
-    else:
+            with open(os.path.join(self.root, name)) as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+def diagnose(prompt, store, endpoint=ENDPOINT, model=MODEL, timeout=TIMEOUT, sig=None):
+    api_key = os.environ.get("OPENAI_API_KEY")
+    if not api_key and endpoint == OPENAI_ENDPOINT:
         print("Specify OPENAI_API_KEY for debugging help")
+        if sig:
+            FailureIndex().release(sig)
+        return None
+    print("🧠 Asking AI for help in the background..")
+    thread = threading.Thread(
+        target=_diagnose,
+        args=(prompt, store, endpoint, model, api_key, timeout, sig),
+        daemon=True,
+    )
+    thread.start()
+    if sig:
+        atexit.register(_abandon, thread, sig)
+    return thread
+
+def prompt_gpt(prompt, endpoint=ENDPOINT, model=MODEL, api_key=None, timeout=TIMEOUT):
+    global _session
+    if _session is None:
+        import requests
+
+        _session = requests.Session()
+        _session.mount(endpoint, requests.adapters.HTTPAdapter(pool_maxsize=4))
+    headers = {"Content-Type": "application/json"}
+    if api_key:
+        headers["Authorization"] = f"Bearer {api_key}"
+    data = {
+        "model": model,
+        "messages": [{"role": "user", "content": prompt}]
+    }
+    response = _session.post(endpoint, headers=headers, json=data, timeout=timeout)
+    response.raise_for_status()
+    return response.json()["choices"][0]["message"]["content"]
+
+def _diagnose(prompt, store, endpoint, model, api_key, timeout, sig):
+    try:
+        resp = prompt_gpt(prompt, endpoint, model, api_key, timeout)
+    except Exception as ex:
+        print(f"🧠 AI diagnosis failed: {ex}", file=sys.stderr)
+        if sig:
+            FailureIndex().release(sig)
+        return
+    if sig:
+        # SQLite connections can't be shared with the step's thread
+        FailureIndex().answer(sig, resp)
+    store.put("diagnosis.md", resp)
+    show_diagnosis(resp)
+
+def show_diagnosis(text):
+    markdown = f"🧠💡 AI suggestion:\n\n{text}"
+    try:
+        from rich.console import Console
+        from rich.markdown import Markdown
+        console = Console()
+        md = Markdown(markdown)
+        console.print(md)
+    except ImportError:
+        print(markdown)
@@ -0,0 +1,190 @@
+import os
+import re
+import sys
+import json
+import time
+import hashlib
+import traceback
+
+INDEX_PATH = os.path.join(
+    os.environ.get(
+        "AI_DEBUG_DIR", os.path.join(os.path.expanduser("~"), ".metaflow_ai_debug")
+    ),
+    "failures.db",
+)
+# a claim on a signature that wasn't answered in this long is given up
+STALE_CLAIM = 300
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS diagnoses (
+    signature TEXT PRIMARY KEY,
+    exception TEXT NOT NULL,
+    diagnosis TEXT,
+    claimed REAL,
+    created REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS failures (
+    signature TEXT NOT NULL,
+    flow TEXT NOT NULL,
+    run_id TEXT NOT NULL,
+    pathspec TEXT NOT NULL,
+    attempt INTEGER NOT NULL,
+    message TEXT,
+    created REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS failures_run ON failures (flow, run_id);
+CREATE INDEX IF NOT EXISTS failures_pathspec ON failures (pathspec);
+"""
+
+
+def signature(exc_type, tb, source):
+    """
+    A fingerprint of a failure that is the same for every task that hits
+    the same bug: the exception type, the function and source text of
+    each frame outside of Metaflow, and a hash of the step's code. Line
+    numbers, values in the message and memory addresses are left out.
+    """
+    frames = [
+        (os.path.basename(frame.filename), frame.name, (frame.line or "").strip())
+        for frame in traceback.extract_tb(tb)
+        if os.sep + "metaflow" + os.sep not in frame.filename
+    ]
+    code = hashlib.sha256(source.encode("utf-8")).hexdigest()
+    data = json.dumps([exc_type.__module__, exc_type.__qualname__, frames, code])
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()[:16]
+
+
+def normalize_message(message):
+    # e.g. ids and sizes differ between the splits of a foreach
+    message = re.sub(r"0x[0-9a-fA-F]+", "0x?", message)
+    return re.sub(r"\d+", "N", message)
+
+
+class FailureIndex(object):
+    """
+    Diagnoses of failures by signature, and every failure seen, in a local
+    SQLite database. The first task to hit a signature claims it and asks
+    for a diagnosis; the others reuse the answer, or skip asking while the
+    claim is pending.
+    """
+
+    def __init__(self, path=INDEX_PATH):
+        import sqlite3
+
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.db = sqlite3.connect(path, timeout=60, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.executescript(SCHEMA)
+
+    def record(self, sig, exc_type, message):
+        from metaflow import current
+
+        self.db.execute(
+            "INSERT INTO failures VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (
+                sig,
+                current.flow_name,
+                current.run_id,
+                current.pathspec,
+                current.retry_count,
+                normalize_message(message),
+                time.time(),
+            ),
+        )
+        self.db.execute(
+            "INSERT OR IGNORE INTO diagnoses (signature, exception, created) VALUES (?, ?, ?)",
+            (sig, exc_type.__name__, time.time()),
+        )
+
+    def claim(self, sig):
+        """
+        Return the diagnosis of `sig` if there is one and whether this task
+        got the claim to ask for it, which it does unless another task holds
+        a claim.
+        """
+        now = time.time()
+        cur = self.db.execute(
+            "UPDATE diagnoses SET claimed = ? WHERE signature = ? AND diagnosis IS NULL "
+            "AND (claimed IS NULL OR claimed < ?)",
+            (now, sig, now - STALE_CLAIM),
+        )
+        if cur.rowcount == 1:
+            return None, True
+        return self.diagnosis(sig), False
+
+    def release(self, sig):
+        # lets the next occurrence ask again, e.g. after the request failed
+        self.db.execute(
+            "UPDATE diagnoses SET claimed = NULL WHERE signature = ? AND diagnosis IS NULL",
+            (sig,),
+        )
+
+    def answer(self, sig, diagnosis):
+        self.db.execute(
+            "UPDATE diagnoses SET diagnosis = ?, claimed = NULL WHERE signature = ?",
+            (diagnosis, sig),
+        )
+
+    def diagnosis(self, sig):
+        row = self.db.execute(
+            "SELECT diagnosis FROM diagnoses WHERE signature = ?", (sig,)
+        ).fetchone()
+        return row and row[0]
+
+    def last_diagnosis(self, pathspec):
+        # the diagnosis of the latest failure of a task, for its next attempt
+        row = self.db.execute(
+            "SELECT d.diagnosis FROM failures f JOIN diagnoses d USING (signature) "
+            "WHERE f.pathspec = ? ORDER BY f.created DESC LIMIT 1",
+            (pathspec,),
+        ).fetchone()
+        return row and row[0]
+
+    def clusters(self, flow_name, run_id):
+        return self.db.execute(
+            "SELECT f.signature, d.exception, COUNT(*), COUNT(DISTINCT f.pathspec), "
+            "MIN(f.pathspec), MIN(f.message), d.diagnosis "
+            "FROM failures f JOIN diagnoses d USING (signature) "
+            "WHERE f.flow = ? AND f.run_id = ? GROUP BY f.signature ORDER BY COUNT(*) DESC",
+            (flow_name, run_id),
+        ).fetchall()
+
+    def latest_run(self, flow_name):
+        row = self.db.execute(
+            "SELECT run_id FROM failures WHERE flow = ? ORDER BY created DESC LIMIT 1",
+            (flow_name,),
+        ).fetchone()
+        return row and row[0]
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Summarize the failures of a run")
+    parser.add_argument("command", choices=["summary"])
+    parser.add_argument("run", help="Flow/run_id, or Flow for its latest failed run")
+    parser.add_argument("--index", default=INDEX_PATH)
+    parser.add_argument("--full", action="store_true", help="print whole diagnoses")
+    args = parser.parse_args()
+
+    index = FailureIndex(args.index)
+    flow_name, _, run_id = args.run.partition("/")
+    run_id = run_id or index.latest_run(flow_name)
+    clusters = index.clusters(flow_name, run_id) if run_id else []
+    if not clusters:
+        print(f"No failures recorded for {args.run}")
+        return 0
+    total = sum(c[2] for c in clusters)
+    print(f"🧩 {flow_name}/{run_id}: {total} failures in {len(clusters)} clusters")
+    for sig, exception, count, tasks, example, message, diagnosis in clusters:
+        print(f"\n[{sig}] {exception} x{count} in {tasks} tasks, e.g. {example}")
+        if message:
+            print(f"    {message}")
+        if diagnosis:
+            text = diagnosis if args.full else diagnosis.strip().splitlines()[0][:120]
+            print(f"    🧠 {text}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1 @@
+../dataset/parquet_cache.py
\ No newline at end of file
@@ -1,6 +1,10 @@
 from metaflow import FlowMutator
 from fallback import fallback
 
+# retries allowed per exception class (matched along its MRO); anything
+# else is treated as deterministic and goes straight to the fallback
+DEFAULT_POLICIES = {"ConnectionError": 3, "TimeoutError": 3}
+
 class robust_flow(FlowMutator):
     def init(self, *args, **kwargs):
         self.disable_fallback = bool(kwargs.get("disable_fallback"))
@@ -8,14 +12,33 @@ class robust_flow(FlowMutator):
         fallback_indicator = kwargs.get("fallback_indicator")
         if fallback_indicator:
             self.fallback_attributes["indicator"] = fallback_indicator
+        self.policies = kwargs.get("retry_policies", DEFAULT_POLICIES)
+        if self.policies:
+            self.fallback_attributes["policies"] = self.policies
+            for key in ("backoff", "max_backoff", "budget", "crash_retries"):
+                if kwargs.get(key) is not None:
+                    self.fallback_attributes[key] = kwargs[key]
+            # retry inside the task instead of relaunching it, for steps
+            # with no other user decorators
+            self.inprocess = bool(kwargs.get("inprocess_retries"))
+            self.fallback_attributes["inprocess"] = self.inprocess
 
     def mutate(self, mutable_flow):
+        retry_kwargs = {}
+        if self.policies and not self.disable_fallback:
+            # one attempt per allowed retry plus one for the fallback; the
+            # fallback decorator does its own backoff between attempts.
+            # In-process retries only relaunch the task after a crash, but
+            # steps with other user decorators still retry by relaunching.
+            times = max(int(n) for n in self.policies.values()) + 1
+            if self.inprocess:
+                times = max(times, int(self.fallback_attributes.get("crash_retries", 1)) + 1)
+            retry_kwargs = {"times": times, "minutes_between_retries": 0}
         for step_name, step in mutable_flow.steps:
-            step.add_decorator("retry", duplicates=step.IGNORE)
+            step.add_decorator("retry", deco_kwargs=retry_kwargs, duplicates=step.IGNORE)
             if not self.disable_fallback:
                 step.add_decorator(
                     fallback,
                     deco_kwargs=self.fallback_attributes,
                     duplicates=step.IGNORE
                 )
-
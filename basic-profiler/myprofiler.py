@@ -1,10 +1,20 @@
 import time
 from metaflow import user_step_decorator, current
 
+from otelexport import get_exporter, make_span, task_context
+
 
 @user_step_decorator
 def my_profile(step_name, flow, inputs=None, attributes=None):
     start = time.time()
-    yield
-    duration = 1000 * (time.time() - start)
-    print(f"⏰ Task [{current.pathspec}] completed in {duration:.1f}ms")
+    start_ns = time.time_ns()
+    try:
+        yield
+    finally:
+        duration = 1000 * (time.time() - start)
+        print(f"⏰ Task [{current.pathspec}] completed in {duration:.1f}ms")
+        if attributes.get("export"):
+            exporter = get_exporter(attributes.get("endpoint"), attributes.get("path"))
+            trace_id, span_id, attrs = task_context(flow)
+            exporter.export(make_span(step_name, trace_id, span_id, None, start_ns, time.time_ns(), attrs))
+            exporter.flush(float(attributes.get("flush_timeout", 2)))
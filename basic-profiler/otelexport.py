@@ -0,0 +1 @@
+../trace-profiler/otelexport.py
\ No newline at end of file
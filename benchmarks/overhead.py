@@ -0,0 +1,359 @@
+"""
+Overhead of the decorators in this repo: runs the example flows and
+generated flows that stack the decorators on a foreach of varying width,
+all with the local metadata and datastore, and writes the per-task
+overhead, mutate time and datastore growth as JSON. Cases that use @pypi
+are skipped unless --environment is given, and failed cases are recorded
+with their error.
+
+    python benchmarks/overhead.py --widths 1,10,50 --output overhead.json
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import subprocess
+from statistics import median
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# directories with the decorator modules the generated flows import
+MODULE_DIRS = [
+    "basic-mutator",
+    "basic-profiler",
+    "dataset",
+    "fallback",
+    "flow-linter",
+    "memoize",
+    "stats-profiler",
+    "trace-profiler",
+]
+
+# name -> (import, decorator, flow or step level, class attribute)
+DECORATORS = {
+    "robust_flow": ("from robust_flow import robust_flow", "@robust_flow", "flow", None),
+    "flow_linter": (
+        "from flow_linter import flow_linter",
+        "@flow_linter",
+        "flow",
+        "limits = Config('limits', default_value={'cpu': 2, 'memory': 16000})",
+    ),
+    "fallback": ("from fallback import fallback", "@fallback", "step", None),
+    "memoize": ("from memoize import memoize", "@memoize(artifacts=['value'])", "step", None),
+    "dataset": (
+        "from dataset import dataset",
+        "@dataset(url=FIXTURE, aggregate={'rows': 'count(*)'})",
+        "step",
+        None,
+    ),
+    "my_profile": ("from myprofiler import my_profile", "@my_profile", "step", None),
+    "stats_profile": ("from statsprofiler import stats_profile", "@stats_profile", "step", None),
+    "trace_profile": ("from traceprofiler import trace_profile", "@trace_profile", "step", None),
+}
+
+STACKS = {
+    "bare": [],
+    "robust": ["robust_flow"],
+    "profilers": ["my_profile", "stats_profile", "trace_profile"],
+    "memoize": ["memoize"],
+    "dataset": ["dataset"],
+    "full": ["robust_flow", "flow_linter", "memoize", "my_profile", "stats_profile", "trace_profile"],
+}
+
+# stacks whose decorators add @pypi, so they need --environment
+PYPI_STACKS = ("dataset",)
+
+# example flows: (directory, file, flow name, extra arguments before `run`,
+# whether it uses @pypi)
+EXAMPLES = [
+    ("basic-profiler", "waiterflow.py", "WaiterFlow", [], False),
+    ("trace-profiler", "traceflow.py", "TracingFlow", [], False),
+    ("basic-mutator", "failflow.py", "FailFlow", [], False),
+    (
+        "baseflow",
+        "composedflow.py",
+        "ComposedFlow",
+        ["--config-value", "dataset", "{dataset}"],
+        True,
+    ),
+]
+
+TEMPLATE = '''from metaflow import FlowSpec, Config, step
+{imports}
+
+FIXTURE = {fixture!r}
+
+{flow_decorators}
+class {name}(FlowSpec):
+{attributes}
+    @step
+    def start(self):
+        self.items = list(range({width}))
+        self.next(self.work, foreach='items')
+
+{step_decorators}
+    @step
+    def work(self):
+        self.value = self.input * 2
+        self.next(self.join)
+
+    @step
+    def join(self, inputs):
+        self.total = sum(inp.value for inp in inputs)
+        self.next(self.end)
+
+    @step
+    def end(self):
+        pass
+
+if __name__ == '__main__':
+    {name}()
+'''
+
+# prints the wall time of each task of a run, in seconds, as JSON
+TASKS_SNIPPET = """
+import sys, json
+from metaflow import Run, namespace
+namespace(None)
+run = Run(sys.argv[1])
+print(json.dumps({
+    step.id: [(task.finished_at - task.created_at).total_seconds() for task in step]
+    for step in run
+}))
+"""
+
+
+def generate_flow(directory, stack, width, fixture):
+    name = "Bench%sW%dFlow" % (stack.title().replace("_", ""), width)
+    specs = [DECORATORS[deco] for deco in STACKS[stack]]
+    source = TEMPLATE.format(
+        imports="\n".join(spec[0] for spec in specs),
+        fixture=fixture,
+        flow_decorators="\n".join(spec[1] for spec in specs if spec[2] == "flow"),
+        name=name,
+        attributes="".join(f"    {spec[3]}\n" for spec in specs if spec[3]),
+        width=width,
+        step_decorators="\n".join(f"    {spec[1]}" for spec in specs if spec[2] == "step"),
+    )
+    path = os.path.join(directory, name.lower() + ".py")
+    with open(path, "w") as f:
+        f.write(source)
+    return path, name
+
+
+def make_fixture(directory, rows):
+    """
+    A local parquet file with the taxi columns the examples read.
+    """
+    import random
+
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    rng = random.Random(0)
+    fares = [round(rng.uniform(2, 80), 2) for _ in range(rows)]
+    table = pa.table(
+        {
+            "fare_amount": fares,
+            "tip_amount": [round(fare * rng.uniform(0, 0.3), 2) for fare in fares],
+            "passenger_count": [rng.randint(1, 4) for _ in range(rows)],
+        }
+    )
+    path = os.path.join(directory, "fixture.parquet")
+    pq.write_table(table, path, row_group_size=max(1, rows // 8))
+    return path
+
+
+def case_env(casedir, sysroot):
+    # a datastore per case, so its size is what the case wrote, and
+    # caches per case, so repetitions don't reuse each other's results
+    env = dict(os.environ)
+    env.update(
+        METAFLOW_DEFAULT_METADATA="local",
+        METAFLOW_DEFAULT_DATASTORE="local",
+        METAFLOW_DATASTORE_SYSROOT_LOCAL=sysroot,
+        MEMOIZE_CACHE_DIR=os.path.join(casedir, "memoize"),
+        DATASET_CACHE_DIR=os.path.join(casedir, "dataset_cache"),
+        FLOW_LINTER_CACHE_DIR=os.path.join(casedir, "flow_linter"),
+        PERF_STORE=os.path.join(casedir, "perf.db"),
+        PYTHONPATH=os.pathsep.join(
+            [os.path.join(ROOT, d) for d in MODULE_DIRS] + [os.environ.get("PYTHONPATH", "")]
+        ),
+    )
+    return env
+
+
+def timed(cmd, cwd, env):
+    start = time.perf_counter()
+    proc = subprocess.run(cmd, cwd=cwd, env=env, capture_output=True, text=True)
+    elapsed = time.perf_counter() - start
+    if proc.returncode != 0:
+        raise Exception("%s failed:\n%s" % (" ".join(cmd), proc.stderr[-2000:]))
+    return elapsed
+
+
+def dir_size(path):
+    total = 0
+    for dirpath, _dirs, files in os.walk(path):
+        for name in files:
+            total += os.path.getsize(os.path.join(dirpath, name))
+    return total
+
+
+def run_case(workdir, flow_dir, flow_file, flow_name, args, environment):
+    casedir = tempfile.mkdtemp(prefix="case-", dir=workdir)
+    sysroot = os.path.join(casedir, "datastore")
+    os.makedirs(sysroot)
+    env = case_env(casedir, sysroot)
+    run_id_file = os.path.join(casedir, "run_id")
+    cmd = [sys.executable, flow_file] + args
+    if environment:
+        cmd.append(f"--environment={environment}")
+    show = timed(cmd + ["show"], flow_dir, env)
+    run = timed(cmd + ["run", "--run-id-file", run_id_file], flow_dir, env)
+    with open(run_id_file) as f:
+        run_id = f.read().strip()
+    out = subprocess.run(
+        [sys.executable, "-c", TASKS_SNIPPET, f"{flow_name}/{run_id}"],
+        cwd=flow_dir,
+        env=env,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    tasks = json.loads(out.stdout.strip().splitlines()[-1])
+    durations = [d for step in tasks.values() for d in step]
+    return {
+        "show_s": show,
+        "run_s": run,
+        "tasks": len(durations),
+        "task_median_s": median(durations),
+        "step_median_s": {step: median(d) for step, d in tasks.items()},
+        "datastore_bytes": dir_size(sysroot),
+    }
+
+
+def best_of(repeat, fn, *args):
+    # the fastest repetition is the least disturbed by noise; a failed
+    # case is recorded as such, so the rest of the report is kept
+    try:
+        results = [fn(*args) for _ in range(repeat)]
+    except Exception as ex:
+        print(f"❌ {ex}", file=sys.stderr)
+        return {"error": str(ex)}
+    return min(results, key=lambda r: r["run_s"])
+
+
+def skipped(uses_pypi, environment):
+    if uses_pypi and not environment:
+        print("⏭️  skipped: uses @pypi, pass --environment=pypi", file=sys.stderr)
+        return {"skipped": "uses @pypi, pass --environment=pypi"}
+    return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--widths", default="1,10,50", help="foreach widths")
+    parser.add_argument("--stacks", default=",".join(STACKS), help="decorator stacks")
+    parser.add_argument("--repeat", type=int, default=1)
+    parser.add_argument("--rows", type=int, default=100_000, help="rows in the parquet fixture")
+    parser.add_argument("--environment", help="e.g. pypi, for the steps that use @pypi")
+    parser.add_argument("--no-examples", action="store_true")
+    parser.add_argument("--output", help="write the results to this file instead of stdout")
+    args = parser.parse_args()
+
+    widths = [int(w) for w in args.widths.split(",")]
+    stacks = args.stacks.split(",")
+    for stack in stacks:
+        if stack not in STACKS:
+            raise Exception(f"unknown stack {stack}, expected one of {', '.join(STACKS)}")
+
+    workdir = tempfile.mkdtemp(prefix="metaflow-bench-")
+    report = {
+        "meta": {
+            "created": time.time(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "widths": widths,
+        },
+        "examples": {},
+        "stacks": {},
+    }
+    try:
+        fixture = make_fixture(workdir, args.rows)
+        if not args.no_examples:
+            for dirname, flow_file, flow_name, extra, uses_pypi in EXAMPLES:
+                extra = [a.format(dataset=json.dumps({"url": fixture})) for a in extra]
+                print(f"🏁 {flow_name}", file=sys.stderr)
+                report["examples"][flow_name] = skipped(
+                    uses_pypi, args.environment
+                ) or best_of(
+                    args.repeat,
+                    run_case,
+                    workdir,
+                    os.path.join(ROOT, dirname),
+                    flow_file,
+                    flow_name,
+                    extra,
+                    args.environment,
+                )
+        flows_dir = os.path.join(workdir, "flows")
+        os.makedirs(flows_dir)
+        for stack in stacks:
+            for width in widths:
+                path, flow_name = generate_flow(flows_dir, stack, width, fixture)
+                print(f"🏁 {stack} x {width}", file=sys.stderr)
+                report["stacks"].setdefault(stack, {})[str(width)] = skipped(
+                    stack in PYPI_STACKS, args.environment
+                ) or best_of(
+                    args.repeat,
+                    run_case,
+                    workdir,
+                    flows_dir,
+                    os.path.basename(path),
+                    flow_name,
+                    [],
+                    args.environment,
+                )
+        add_overheads(report["stacks"])
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    out = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(out)
+    else:
+        print(out)
+
+
+def add_overheads(stacks):
+    """
+    Compare every stack with the bare flow of the same width: the extra
+    time per `work` task, the extra `show` time (the mutators) and the
+    extra datastore bytes per task.
+    """
+    bare = stacks.get("bare")
+    if not bare:
+        return
+    for results in stacks.values():
+        for width, result in results.items():
+            base = bare.get(width)
+            if base is None or "run_s" not in base or "run_s" not in result:
+                continue
+            result["overhead"] = {
+                "task_s": result["step_median_s"]["work"] - base["step_median_s"]["work"],
+                "mutate_s": result["show_s"] - base["show_s"],
+                "datastore_bytes_per_task": (
+                    result["datastore_bytes"] - base["datastore_bytes"]
+                )
+                / result["tasks"],
+            }
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,191 @@
+"""
+Startup time of the example flows: `python flow.py show`, and the time a
+task spends importing the flow module and its decorators on top of
+Metaflow itself. Compares the medians against a baseline and exits with
+1 on a regression. Flows that use @pypi are skipped unless --environment
+is given.
+
+The baseline is recorded on the first run, and with the machine it was
+measured on, since the numbers are only comparable on the same one.
+
+    python benchmarks/startup.py              # compare against the baseline
+    python benchmarks/startup.py --update     # record a new one
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import subprocess
+from statistics import median
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BASELINE = os.environ.get(
+    "STARTUP_BASELINE",
+    os.path.join(os.path.expanduser("~"), ".metaflow_perf", "startup_baseline.json"),
+)
+
+FLOWS = [
+    ("ai-debug", "failflow.py"),
+    ("baseflow", "composedflow.py"),
+    ("basic-mutator", "failflow.py"),
+    ("basic-profiler", "waiterflow.py"),
+    ("checkpoint", "checkpointflow.py"),
+    ("checkpoint", "robustcheckpointflow.py"),
+    ("dataset", "datasetflow.py"),
+    ("fallback", "failflow.py"),
+    ("flow-linter", "hungryflow.py"),
+    ("memoize", "multiplyflow.py"),
+    ("memoize", "totalfare.py"),
+    ("namespaced_events", "child_flow.py"),
+    ("resource-profiler", "resourceflow.py"),
+    ("sample-profiler", "sampleflow.py"),
+    ("stats-profiler", "waiterflow.py"),
+    ("trace-profiler", "traceflow.py"),
+]
+
+# flows that use @pypi, which `show` rejects without --environment
+PYPI_FLOWS = ("baseflow/composedflow.py", "dataset/datasetflow.py", "memoize/totalfare.py")
+
+# prints the milliseconds it takes to import the flow module once
+# Metaflow is loaded, which is what the decorator modules add to a task
+IMPORT_SNIPPET = """
+import sys, time, metaflow
+sys.path.insert(0, ".")
+start = time.perf_counter()
+__import__(sys.argv[1])
+print(1000 * (time.perf_counter() - start))
+"""
+
+
+def local_env():
+    env = dict(os.environ)
+    env.update(METAFLOW_DEFAULT_METADATA="local", METAFLOW_DEFAULT_DATASTORE="local")
+    return env
+
+
+def time_show(directory, flow, env, environment=None):
+    cmd = [sys.executable, flow]
+    if environment:
+        cmd.append(f"--environment={environment}")
+    start = time.perf_counter()
+    subprocess.run(
+        cmd + ["show"],
+        cwd=directory,
+        env=env,
+        check=True,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    return 1000 * (time.perf_counter() - start)
+
+
+def time_import(directory, flow, env):
+    out = subprocess.run(
+        [sys.executable, "-c", IMPORT_SNIPPET, flow[: -len(".py")]],
+        cwd=directory,
+        env=env,
+        check=True,
+        capture_output=True,
+        text=True,
+    )
+    return float(out.stdout.strip().splitlines()[-1])
+
+
+def measure(repeat, environment=None):
+    env = local_env()
+    results, failed, seen = {}, [], set()
+    for dirname, flow in FLOWS:
+        name = f"{dirname}/{flow}"
+        # symlinked flows import the decorator modules next to their target
+        path = os.path.realpath(os.path.join(ROOT, dirname, flow))
+        directory, flow = os.path.split(path)
+        if path in seen:
+            continue
+        seen.add(path)
+        if name in PYPI_FLOWS and not environment:
+            print(f"⏭️  {name} skipped: uses @pypi, pass --environment=pypi")
+            continue
+        try:
+            show = [time_show(directory, flow, env, environment) for _ in range(repeat)]
+            imports = [time_import(directory, flow, env) for _ in range(repeat)]
+        except subprocess.CalledProcessError as ex:
+            print(f"❌ {name} failed: {ex}", file=sys.stderr)
+            failed.append(name)
+            continue
+        results[name] = {"show_ms": median(show), "import_ms": median(imports)}
+        print(
+            f"{name:<40}show {results[name]['show_ms']:8.1f}ms"
+            f"   import {results[name]['import_ms']:8.1f}ms"
+        )
+    return results, failed
+
+
+def machine():
+    import metaflow
+
+    return {
+        "node": platform.node(),
+        "system": platform.system(),
+        "machine": platform.machine(),
+        "processor": platform.processor(),
+        "cpus": os.cpu_count(),
+        "python": platform.python_version(),
+        "metaflow": metaflow.__version__,
+    }
+
+
+def regressions(results, baseline, tolerance, slack_ms):
+    found = []
+    for name, metrics in results.items():
+        for metric, value in metrics.items():
+            base = baseline.get(name, {}).get(metric)
+            # the absolute slack keeps noise on fast imports from failing
+            if base is not None and value > base * (1 + tolerance) + slack_ms:
+                found.append((name, metric, base, value))
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--baseline", default=BASELINE)
+    parser.add_argument("--update", action="store_true", help="record a new baseline")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed relative slowdown")
+    parser.add_argument("--slack-ms", type=float, default=20.0, help="allowed absolute slowdown")
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    parser.add_argument("--environment", help="e.g. pypi, for the flows that use @pypi")
+    args = parser.parse_args()
+
+    results, failed = measure(args.repeat, args.environment)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if failed:
+        return 1
+    if args.update or not os.path.exists(args.baseline):
+        os.makedirs(os.path.dirname(os.path.abspath(args.baseline)), exist_ok=True)
+        with open(args.baseline, "w") as f:
+            json.dump({"machine": machine(), "results": results}, f, indent=2, sort_keys=True)
+        print(f"📝 baseline written to {args.baseline}")
+        return 0
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    if baseline.get("machine") != machine():
+        print(
+            f"⚠️  {args.baseline} was recorded on another machine or setup, "
+            "not comparing; record one here with --update"
+        )
+        return 0
+    baseline = baseline["results"]
+    found = regressions(results, baseline, args.tolerance, args.slack_ms)
+    for name, metric, base, value in found:
+        print(f"❌ {name} {metric}: {value:.1f}ms vs {base:.1f}ms in the baseline")
+    if not found:
+        print("✅ no startup regressions")
+    return 1 if found else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,186 @@
+import os
+import sys
+import zlib
+import pickle
+import threading
+from metaflow import user_step_decorator, current
+
+
+@user_step_decorator
+def checkpoint(step_name, flow, inputs=None, attributes=None):
+    store = CheckpointStore(
+        storage_for(current.pathspec),
+        keep=int(attributes.get("keep", 3)),
+        level=int(attributes.get("compression", 3)),
+    )
+    flow.checkpoint = store
+    if current.retry_count and store.names():
+        print(f"♻️  checkpoint found: the step can resume with self.checkpoint.load()")
+    try:
+        yield
+    except:
+        # make sure the retry sees the latest state
+        try:
+            store.close(timeout=float(attributes.get("flush_timeout", 120)))
+        except Exception:
+            # reported by the writer already, the step's error goes first
+            pass
+        raise
+    finally:
+        del flow.checkpoint
+    store.close(flush=False)
+    if not attributes.get("keep_on_success"):
+        store.clear()
+
+
+class CheckpointStore(object):
+    """
+    `save(state)` pickles the state right away and hands it to a
+    background thread that compresses and writes it, keeping the last
+    `keep` checkpoints. If the writer is still busy, a newer state
+    replaces the one waiting to be written, so saving never blocks.
+    A failed write is printed, and raised again by `close()`.
+    """
+
+    def __init__(self, storage, keep=3, level=3):
+        self.storage = storage
+        self.keep = keep
+        self.level = level
+        self.seq = max([int(name.split(".")[0]) for name in self.names()], default=0)
+        self._latest = None
+        self._pending = None
+        self._writing = False
+        self._closed = False
+        self._error = None
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def save(self, state):
+        blob = pickle.dumps(state, protocol=4)
+        with self._cond:
+            self.seq += 1
+            self._latest = blob
+            self._pending = (self.seq, blob)
+            self._cond.notify_all()
+
+    def load(self, default=None):
+        if self._latest is not None:
+            return pickle.loads(self._latest)
+        names = self.names()
+        if not names:
+            return default
+        return pickle.loads(zlib.decompress(self.storage.get(names[-1])))
+
+    def names(self):
+        return sorted(name for name in self.storage.list() if name.endswith(".ckpt"))
+
+    def close(self, flush=True, timeout=None):
+        with self._cond:
+            if not flush:
+                self._pending = None
+            self._closed = True
+            self._cond.notify_all()
+        self._thread.join(timeout)
+        if self._error is not None:
+            raise Exception("checkpoint could not be written: %s" % self._error)
+
+    def clear(self):
+        for name in self.names():
+            self.storage.delete(name)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while self._pending is None and not self._closed:
+                    self._cond.wait()
+                if self._pending is None:
+                    return
+                seq, blob = self._pending
+                self._pending = None
+            try:
+                self.storage.put("%08d.ckpt" % seq, zlib.compress(blob, self.level))
+                # the checkpoint just written is always kept, also with keep=0
+                keep = self.keep if self.keep > 0 else 1
+                for name in self.names()[:-keep]:
+                    self.storage.delete(name)
+            except Exception as ex:
+                # keep draining, so later saves still get a chance
+                print(f"⚠️  checkpoint {seq} could not be written: {ex}", file=sys.stderr)
+                self._error = ex
+
+
+def storage_for(pathspec):
+    """
+    Checkpoints live next to the flow's datastore, under the task's
+    pathspec, which stays the same across retries.
+    """
+    from metaflow.metaflow_config import (
+        DEFAULT_DATASTORE,
+        DATASTORE_SYSROOT_LOCAL,
+        DATASTORE_SYSROOT_S3,
+    )
+
+    if DEFAULT_DATASTORE == "s3":
+        return S3Storage(os.path.join(DATASTORE_SYSROOT_S3, "checkpoints", pathspec))
+    root = DATASTORE_SYSROOT_LOCAL or os.path.join(os.getcwd(), ".metaflow")
+    return LocalStorage(os.path.join(root, "checkpoints", pathspec))
+
+
+class LocalStorage(object):
+    def __init__(self, root):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def put(self, name, blob):
+        tmp = os.path.join(self.root, f".{name}.tmp")
+        with open(tmp, "wb") as f:
+            f.write(blob)
+        os.replace(tmp, os.path.join(self.root, name))
+
+    def get(self, name):
+        with open(os.path.join(self.root, name), "rb") as f:
+            return f.read()
+
+    def list(self):
+        return os.listdir(self.root)
+
+    def delete(self, name):
+        try:
+            os.unlink(os.path.join(self.root, name))
+        except FileNotFoundError:
+            pass
+
+
+class S3Storage(object):
+    def __init__(self, root):
+        self.root = root
+
+    def put(self, name, blob):
+        from metaflow import S3
+
+        with S3(s3root=self.root) as s3:
+            s3.put(name, blob)
+
+    def get(self, name):
+        from metaflow import S3
+
+        with S3(s3root=self.root) as s3:
+            return s3.get(name).blob
+
+    def list(self):
+        from metaflow import S3
+
+        with S3(s3root=self.root) as s3:
+            return [obj.key for obj in s3.list_paths()]
+
+    def delete(self, name):
+        # metaflow.S3 can't delete objects
+        try:
+            import boto3
+        except ImportError:
+            return
+        from urllib.parse import urlparse
+
+        url = urlparse(os.path.join(self.root, name))
+        boto3.client("s3").delete_object(Bucket=url.netloc, Key=url.path.lstrip("/"))
@@ -0,0 +1,30 @@
+import time
+import random
+from metaflow import FlowSpec, step, retry
+
+from checkpoint import checkpoint
+
+class CheckpointFlow(FlowSpec):
+
+    @retry(times=3)
+    @checkpoint(keep=2)
+    @step
+    def start(self):
+        state = self.checkpoint.load(default={'i': 0, 'total': 0})
+        print(f"▶️  starting at iteration {state['i']}")
+        while state['i'] < 20:
+            time.sleep(0.1)
+            state['total'] += state['i']
+            state['i'] += 1
+            self.checkpoint.save(state)
+            if random.random() < 0.05:
+                raise Exception("💥 simulated crash")
+        self.total = state['total']
+        self.next(self.end)
+
+    @step
+    def end(self):
+        print(f"Total: {self.total}")
+
+if __name__ == '__main__':
+    CheckpointFlow()
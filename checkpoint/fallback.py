@@ -0,0 +1 @@
+../fallback/fallback.py
\ No newline at end of file
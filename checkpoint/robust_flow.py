@@ -0,0 +1 @@
+../basic-mutator/robust_flow.py
\ No newline at end of file
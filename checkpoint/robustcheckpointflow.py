@@ -0,0 +1,31 @@
+import time
+from metaflow import FlowSpec, step, current
+
+from checkpoint import checkpoint
+from robust_flow import robust_flow
+
+@robust_flow(fallback_indicator='failed', backoff=0.5)
+class RobustCheckpointFlow(FlowSpec):
+
+    @checkpoint(keep=2)
+    @step
+    def start(self):
+        state = self.checkpoint.load(default={'i': 0, 'total': 0})
+        print(f"▶️  attempt {current.retry_count} starting at iteration {state['i']}")
+        while state['i'] < 20:
+            time.sleep(0.1)
+            state['total'] += state['i']
+            state['i'] += 1
+            self.checkpoint.save(state)
+            if current.retry_count == 0 and state['i'] == 10:
+                # transient, so robust_flow relaunches the task
+                raise ConnectionError("💥 simulated network failure")
+        self.total = state['total']
+        self.next(self.end)
+
+    @step
+    def end(self):
+        print(f"Total: {self.total}, fallback: {getattr(self, 'failed', False)}")
+
+if __name__ == '__main__':
+    RobustCheckpointFlow()
@@ -1,33 +1,499 @@
+import os
+import re
+import json
+import hashlib
+import tempfile
+
 from metaflow import StepMutator, config_expr, current, user_step_decorator
 
+from parquet_cache import CACHE_DIR, cached_path, validator
+
 DEPS = {"duckdb": "1.3.2", "pyarrow": "20.0.0"}
 
+# table: materialized pyarrow.Table (default)
+# relation: lazy DuckDB relation, evaluated when the step consumes it
+# batches: pyarrow.RecordBatchReader streaming `batch_size` rows at a time
+# ipc: batches spilled to an Arrow IPC file and memory-mapped as a Table
+MODES = ("table", "relation", "batches", "ipc")
+
+OPERATORS = ("=", "!=", "<", "<=", ">", ">=", "in", "not in")
+AGGREGATE = re.compile(
+    r"^\s*(count|sum|min|max|avg)\(\s*(\*|[A-Za-z_][A-Za-z0-9_]*)\s*\)\s*$", re.I
+)
+
+# compression of the Arrow IPC files that tables left on the flow are
+# stored as. None keeps the buffers uncompressed, so memory-mapped reads
+# are zero-copy; "zstd" or "lz4" make smaller files that are decompressed
+# into memory when read
+ARROW_COMPRESSION = None
+
+# DuckDB connections are shared by all tasks that run in this process,
+# e.g. in-process retries, keyed by database and settings
+_CONNECTIONS = {}
+
 @user_step_decorator
 def process_dataset(step_name, flow, inputs=None, attr=None):
+    if attr.get("partitions"):
+        print("🔄 Planning partitions")
+        flow.partitions = plan_partitions(attr["url"], int(attr["partitions"]))
+        yield
+        return
+    url = attr["url"]
+    columns = attr.get("columns")
+    aggregate = attr.get("aggregate")
+    where, params = compile_filter(attr.get("filter"))
+    mode = attr.get("mode") or "table"
+    batch_size = int(attr.get("batch_size") or 1_000_000)
+    settings = {"threads": attr.get("threads"), "memory_limit": attr.get("memory_limit")}
+    partition = flow.input if attr.get("partitioned") else None
+    if aggregate:
+        # only the aggregated columns are scanned and no rows are materialized
+        select = compile_aggregate(aggregate)
+    else:
+        select = ", ".join(map(quote_ident, columns)) if columns else "*"
+    result_db = result_path(attr, params, partition) if attr.get("result_cache") else None
+    print("🔄 Preparing data")
+    con = spill = None
+    try:
+        if result_db and os.path.exists(result_db):
+            print("✅ Reusing a cached result")
+            con = connection(result_db, read_only=True, **settings).cursor()
+            sql, params = "SELECT * FROM result", []
+        else:
+            con = connection(**settings).cursor()
+            if partition:
+                # scan only this split's row groups; the rest of the query runs
+                # over the slice as usual
+                con.register("partition", read_partition(url, partition, needed_columns(attr)))
+                source = "partition"
+            else:
+                if attr.get("cache", True):
+                    url = cached_path(url, columns=needed_columns(attr))
+                source = f"read_parquet({sql_literal(url)})"
+            check_columns(con, source, attr)
+            sql = f"SELECT {select} FROM {source}{where}"
+            if result_db:
+                store_result(con, sql, params, result_db)
+                con.close()
+                con = connection(result_db, read_only=True, **settings).cursor()
+                sql, params = "SELECT * FROM result", []
+        if aggregate:
+            flow.table = dict(zip(aggregate, con.execute(sql, params).fetchone()))
+        elif mode == "relation":
+            flow.table = con.sql(sql, params=params or None)
+        elif mode == "batches":
+            flow.table = con.execute(sql, params).fetch_record_batch(batch_size)
+        elif mode == "ipc":
+            reader = con.execute(sql, params).fetch_record_batch(batch_size)
+            spill = spill_to_ipc(reader, attr.get("spill_dir"))
+            flow.table = open_ipc(spill)
+        else:
+            flow.table = con.execute(sql, params).fetch_arrow_table()
+        print("✅ Data prepared")
+        yield
+        if not attr.get("keep_table") or mode in ("relation", "batches"):
+            del flow.table
+        store_tables(flow, attr.get("arrow_compression"))
+    finally:
+        # also when the step or the setup fails, so a retry doesn't leak either
+        if con is not None:
+            con.close()
+        if spill:
+            os.unlink(spill)
+
+def connection(database=":memory:", read_only=False, threads=None, memory_limit=None):
     import duckdb
 
-    sql = f"""SELECT * FROM '{attr["url"]}'"""
+    key = (database, read_only, threads, memory_limit)
+    if key not in _CONNECTIONS:
+        config = {}
+        if threads:
+            config["threads"] = int(threads)
+        if memory_limit:
+            config["memory_limit"] = memory_limit
+        _CONNECTIONS[key] = duckdb.connect(database, read_only=read_only, config=config)
+    return _CONNECTIONS[key]
+
+def result_path(attr, params, partition=None):
+    root = attr["result_cache"]
+    if not isinstance(root, str):
+        root = os.path.join(CACHE_DIR, "results")
+    os.makedirs(root, exist_ok=True)
+    key = json.dumps(
+        [
+            attr["url"],
+            validator(attr["url"]),
+            attr.get("filter"),
+            params,
+            attr.get("columns"),
+            attr.get("aggregate"),
+            partition and partition["row_groups"],
+        ],
+        sort_keys=True,
+        default=str,
+    )
+    return os.path.join(root, hashlib.sha256(key.encode("utf-8")).hexdigest() + ".duckdb")
+
+def store_result(con, sql, params, path):
+    # build the database next to its final path and move it in place, so
+    # concurrent readers only ever see a complete result
+    tmp = f"{path}.{os.getpid()}.tmp"
+    con.execute(f"ATTACH {sql_literal(tmp)} AS result_cache")
+    try:
+        con.execute(f"CREATE TABLE result_cache.result AS {sql}", params)
+    finally:
+        con.execute("DETACH result_cache")
+    os.replace(tmp, path)
+
+def sql_literal(value):
+    return "'%s'" % str(value).replace("'", "''")
+
+def quote_ident(name):
+    return '"%s"' % name.replace('"', '""')
+
+def compile_filter(fltr):
+    """
+    A string filter is used as a SQL predicate as-is. A list of
+    [column, operator, value] triples is ANDed together with the values
+    passed as query parameters, so DuckDB can push them into the scan.
+    """
+    if not fltr:
+        return "", []
+    if isinstance(fltr, str):
+        return f" WHERE {fltr}", []
+    clauses, params = [], []
+    for column, op, value in fltr:
+        op = op.lower()
+        if op in ("in", "not in"):
+            value = list(value)
+            marks = ", ".join("?" for _ in value)
+            clauses.append(f"{quote_ident(column)} {op.upper()} ({marks})")
+            params.extend(value)
+        else:
+            clauses.append(f"{quote_ident(column)} {op} ?")
+            params.append(value)
+    return " WHERE " + " AND ".join(clauses), params
+
+def compile_aggregate(aggregate):
+    exprs = []
+    for name, spec in aggregate.items():
+        func, column = AGGREGATE.match(spec).groups()
+        column = column if column == "*" else quote_ident(column)
+        exprs.append(f"{func.lower()}({column}) AS {quote_ident(name)}")
+    return ", ".join(exprs)
+
+def referenced_columns(attr):
+    columns = set(attr.get("columns") or [])
     fltr = attr.get("filter")
-    if fltr:
-        sql += f"WHERE {fltr}"
-    con = duckdb.connect()
-    print("🔄 Preparing data")
-    flow.table = con.execute(sql).fetch_arrow_table()
-    print("✅ Data prepared")
+    if fltr and not isinstance(fltr, str):
+        columns.update(column for column, _op, _value in fltr)
+    for spec in (attr.get("aggregate") or {}).values():
+        column = AGGREGATE.match(spec).group(2)
+        if column != "*":
+            columns.add(column)
+    return columns
+
+def needed_columns(attr):
+    # a raw SQL filter may reference any column
+    if isinstance(attr.get("filter"), str) or not (
+        attr.get("columns") or attr.get("aggregate")
+    ):
+        return None
+    return referenced_columns(attr)
+
+def check_columns(con, source, attr):
+    # DESCRIBE only reads the parquet footer
+    schema = {row[0] for row in con.execute(f"DESCRIBE SELECT * FROM {source}").fetchall()}
+    unknown = referenced_columns(attr) - schema
+    if unknown:
+        raise Exception(
+            "@dataset: unknown columns %s in %s" % (", ".join(sorted(unknown)), attr["url"])
+        )
+
+def validate(columns, fltr, aggregate):
+    if columns is not None and not (
+        isinstance(columns, (list, tuple)) and all(isinstance(c, str) for c in columns)
+    ):
+        raise Exception("@dataset columns must be a list of column names")
+    if fltr and not isinstance(fltr, str):
+        for clause in fltr:
+            if len(clause) != 3 or str(clause[1]).lower() not in OPERATORS:
+                raise Exception(
+                    "@dataset filter clauses must be [column, op, value] with op in %s"
+                    % ", ".join(OPERATORS)
+                )
+    for name, spec in (aggregate or {}).items():
+        match = AGGREGATE.match(spec) if isinstance(spec, str) else None
+        if match is None or (match.group(2) == "*" and match.group(1).lower() != "count"):
+            raise Exception(
+                "@dataset aggregate %r must look like count(*) or sum(column), got %r"
+                % (name, spec)
+            )
+
+def plan_partitions(url, n):
+    """
+    Split the parquet file at `url` into at most `n` contiguous ranges of
+    row groups with roughly equal row counts, using only its footer.
+    """
+    import pyarrow.parquet as pq
+
+    md = pq.read_metadata(cached_path(url, row_groups=[]))
+    target = md.num_rows / max(1, n)
+    partitions, row_groups, rows, seen = [], [], 0, 0
+    for i in range(md.num_row_groups):
+        row_groups.append(i)
+        rows += md.row_group(i).num_rows
+        seen += md.row_group(i).num_rows
+        if seen >= target * (len(partitions) + 1) and len(partitions) < n - 1:
+            partitions.append({"row_groups": row_groups, "rows": rows, "index": len(partitions)})
+            row_groups, rows = [], 0
+    if row_groups:
+        partitions.append({"row_groups": row_groups, "rows": rows, "index": len(partitions)})
+    return partitions
+
+def read_partition(url, partition, columns=None):
+    import pyarrow.parquet as pq
+
+    path = cached_path(url, columns=columns, row_groups=partition["row_groups"])
+    return pq.ParquetFile(path).read_row_groups(
+        partition["row_groups"], columns=None if columns is None else sorted(columns)
+    )
+
+@user_step_decorator
+def arrow_tables(step_name, flow, inputs=None, attr=None):
+    """
+    Store the Arrow tables a step without @dataset leaves on the flow,
+    e.g. the result of merge_tables in a join, as Arrow IPC files.
+    """
     yield
-    del flow.table
+    store_tables(flow, attr.get("compression", ARROW_COMPRESSION))
+
+def merge_tables(inputs, name="table", columns=None):
+    """
+    Concatenate the Arrow tables stored as `name` by each split in a join,
+    reading only `columns` of tables stored as Arrow IPC files.
+    """
+    import pyarrow as pa
+
+    tables = []
+    for inp in inputs:
+        table = getattr(inp, name)
+        if isinstance(table, ArrowArtifact):
+            table = table.read(columns)
+        elif columns is not None:
+            table = table.select(columns)
+        tables.append(table)
+    return pa.concat_tables(tables)
+
+def store_tables(flow, compression=ARROW_COMPRESSION):
+    """
+    Replace every pyarrow.Table the step set on the flow with an
+    ArrowArtifact, so the table is written once as an Arrow IPC file
+    instead of being pickled with the other artifacts.
+    """
+    import pyarrow as pa
+
+    for name, value in list(vars(flow).items()):
+        if isinstance(value, pa.Table):
+            setattr(flow, name, ArrowArtifact.write(value, name, compression))
+
+def arrow_url(name):
+    # next to the flow's datastore, by task and attempt, so the files of
+    # a failed attempt are never read by the steps after a retry
+    from metaflow.metaflow_config import (
+        DEFAULT_DATASTORE,
+        DATASTORE_SYSROOT_LOCAL,
+        DATASTORE_SYSROOT_S3,
+    )
+
+    key = "%s/%s.%d.arrow" % (current.pathspec, name, current.retry_count)
+    if DEFAULT_DATASTORE == "s3":
+        return os.path.join(DATASTORE_SYSROOT_S3, "arrow", key)
+    root = DATASTORE_SYSROOT_LOCAL or os.path.join(os.getcwd(), ".metaflow")
+    return os.path.join(os.path.abspath(root), "arrow", key)
+
+class ArrowArtifact(object):
+    """
+    A pyarrow.Table stored as an Arrow IPC file. Only its location, schema
+    and row count are pickled with the task's artifacts. Reads memory-map
+    the file (fetched once into the dataset cache from S3) and load only
+    the buffers of the columns asked for; any other attribute is looked
+    up on the whole table, so it can be used much like one.
+    """
+
+    def __init__(self, url, schema, num_rows):
+        self.url = url
+        self.schema = schema
+        self.num_rows = num_rows
+        self._table = None
+
+    @classmethod
+    def write(cls, table, name, compression=ARROW_COMPRESSION):
+        import pyarrow as pa
+
+        url = arrow_url(name)
+        path = cache_path(url) if url.startswith("s3://") else url
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.{os.getpid()}.tmp"
+        options = pa.ipc.IpcWriteOptions(compression=compression)
+        with pa.ipc.new_file(tmp, table.schema, options=options) as writer:
+            writer.write_table(table)
+        os.replace(tmp, path)
+        if path != url:
+            from metaflow import S3
+
+            with S3() as s3:
+                s3.put_files([(url, path)])
+        return cls(url, table.schema, table.num_rows)
+
+    @property
+    def column_names(self):
+        return self.schema.names
+
+    def read(self, columns=None):
+        import pyarrow as pa
+
+        options = None
+        if columns is not None:
+            missing = [c for c in columns if c not in self.schema.names]
+            if missing:
+                raise Exception(
+                    "%s has no columns %s, it has %s"
+                    % (self.url, ", ".join(missing), ", ".join(self.schema.names))
+                )
+            fields = sorted(self.schema.get_field_index(c) for c in columns)
+            options = pa.ipc.IpcReadOptions(included_fields=fields)
+        source = pa.memory_map(self.local_path(), "r")
+        table = pa.ipc.open_file(source, options=options).read_all()
+        return table if columns is None else table.select(columns)
+
+    def select(self, columns):
+        return self.read(columns)
+
+    def column(self, name):
+        return self.read([name]).column(0)
+
+    def local_path(self):
+        if not self.url.startswith("s3://"):
+            return self.url
+        path = cache_path(self.url)
+        if not os.path.exists(path):
+            from metaflow import S3
+
+            # files are never rewritten under the same url, so a copy
+            # that exists is complete and current
+            with S3(tmproot=os.path.dirname(path)) as s3:
+                os.replace(s3.get(self.url).path, path)
+        return path
+
+    def __len__(self):
+        return self.num_rows
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        if self._table is None:
+            self._table = self.read()
+        return getattr(self._table, name)
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state["_table"] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+
+    def __repr__(self):
+        return "ArrowArtifact(%s, %d rows, %d columns)" % (
+            self.url,
+            self.num_rows,
+            len(self.schema),
+        )
+
+def cache_path(url):
+    root = os.path.join(CACHE_DIR, "arrow")
+    os.makedirs(root, exist_ok=True)
+    return os.path.join(root, hashlib.sha256(url.encode("utf-8")).hexdigest()[:32] + ".arrow")
+
+def spill_to_ipc(reader, spill_dir=None):
+    import pyarrow as pa
+
+    fd, path = tempfile.mkstemp(suffix=".arrow", dir=spill_dir)
+    try:
+        with os.fdopen(fd, "wb") as sink:
+            with pa.ipc.new_file(sink, reader.schema) as writer:
+                for batch in reader:
+                    writer.write_batch(batch)
+    except BaseException:
+        os.unlink(path)
+        raise
+    return path
+
+def open_ipc(path):
+    import pyarrow as pa
+
+    # buffers point into the mapped file, so reading the table is zero-copy
+    return pa.ipc.open_file(pa.memory_map(path, "r")).read_all()
 
 class dataset(StepMutator):
     def init(self, *args, **kwargs):
         self.url = kwargs["url"]
         self.filter = kwargs.get("filter")
+        self.mode = kwargs.get("mode", "table")
+        self.batch_size = kwargs.get("batch_size")
+        self.spill_dir = kwargs.get("spill_dir")
+        self.columns = kwargs.get("columns")
+        self.aggregate = kwargs.get("aggregate")
+        self.cache = kwargs.get("cache", True)
+        self.partitions = kwargs.get("partitions")
+        self.partitioned = bool(kwargs.get("partitioned"))
+        self.result_cache = kwargs.get("result_cache")
+        self.threads = kwargs.get("threads")
+        self.memory_limit = kwargs.get("memory_limit")
+        self.keep_table = bool(kwargs.get("keep_table"))
+        self.arrow_compression = kwargs.get("arrow_compression", ARROW_COMPRESSION)
+        if self.partitions and self.partitioned:
+            raise Exception(
+                "@dataset takes either partitions (to plan a foreach) "
+                "or partitioned (to scan a planned split), not both"
+            )
+        validate(self.columns, self.filter, self.aggregate)
+        if self.mode not in MODES:
+            raise Exception(
+                "@dataset mode must be one of %s, got %r" % (", ".join(MODES), self.mode)
+            )
 
     def mutate(self, mutable_step):
+        threads, memory_limit = self.threads, self.memory_limit
+        for deco_name, _module, _args, attributes in mutable_step.decorator_specs:
+            if deco_name in ("kubernetes", "batch", "resources"):
+                if not threads and attributes.get("cpu"):
+                    threads = int(float(attributes["cpu"]))
+                # leave headroom for Python and Arrow next to DuckDB
+                if not memory_limit and attributes.get("memory"):
+                    memory_limit = "%dMB" % (0.75 * float(attributes["memory"]))
         mutable_step.add_decorator(
             "pypi", deco_kwargs={"packages": DEPS}, duplicates=mutable_step.ERROR
         )
         mutable_step.add_decorator(
             process_dataset,
-            deco_kwargs={"filter": self.filter, "url": self.url},
+            deco_kwargs={
+                "filter": self.filter,
+                "url": self.url,
+                "mode": self.mode,
+                "batch_size": self.batch_size,
+                "spill_dir": self.spill_dir,
+                "columns": self.columns,
+                "aggregate": self.aggregate,
+                "cache": self.cache,
+                "partitions": self.partitions,
+                "partitioned": self.partitioned,
+                "result_cache": self.result_cache,
+                "threads": threads,
+                "memory_limit": memory_limit,
+                "keep_table": self.keep_table,
+                "arrow_compression": self.arrow_compression,
+            },
             duplicates=mutable_step.ERROR,
         )
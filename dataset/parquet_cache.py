@@ -0,0 +1,237 @@
+import os
+import json
+import fcntl
+import hashlib
+import urllib.request
+from contextlib import contextmanager
+
+CACHE_DIR = os.environ.get(
+    "DATASET_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".metaflow_dataset_cache")
+)
+MAX_BYTES = int(os.environ.get("DATASET_CACHE_MAX_MB", 20 * 1024)) * 1024**2
+
+# shared locks on the entries this process has handed out; eviction by
+# any task skips them until the process exits
+_pins = {}
+
+# ranges closer than this are fetched with a single request
+COALESCE_GAP = 1024**2
+FOOTER_GUESS = 64 * 1024
+
+
+def cached_path(url, columns=None, row_groups=None, max_bytes=MAX_BYTES):
+    """
+    Return a local path for the parquet file at `url`.
+
+    The file is kept in a shared cache directory, validated against the
+    server's ETag (or Last-Modified) and size. With `columns` and/or
+    `row_groups` given, the local copy is a sparse file in which only the
+    footer and the byte ranges of the requested column chunks are filled
+    in, which is all a projected scan of those columns reads. Tasks on
+    the same node serialize on a lock file, so a file is downloaded once,
+    and the file stays pinned for as long as this process runs, so it
+    can't be evicted before the caller has read it.
+    """
+    if not url.startswith(("http://", "https://")):
+        return url
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    key = hashlib.sha256(url.encode("utf-8")).hexdigest()[:32]
+    data = os.path.join(CACHE_DIR, key + ".parquet")
+    meta = os.path.join(CACHE_DIR, key + ".json")
+    with _locked(os.path.join(CACHE_DIR, key + ".lock")):
+        validator, size = _head(url)
+        state = _load(meta)
+        if (
+            state.get("validator") != validator
+            or state.get("size") != size
+            or not os.path.exists(data)
+        ):
+            state = {"url": url, "validator": validator, "size": size, "ranges": []}
+            with open(data, "wb") as f:
+                f.truncate(size)
+        if columns is None and row_groups is None:
+            _ensure(data, meta, state, [(0, size)])
+        else:
+            _ensure(data, meta, state, [(0, 4), (max(0, size - FOOTER_GUESS), size)])
+            _ensure(data, meta, state, [_footer_range(data, size)])
+            _ensure(data, meta, state, chunk_ranges(data, columns, row_groups))
+        os.utime(data)
+        _pin(os.path.join(CACHE_DIR, key + ".pin"))
+    evict(max_bytes, keep=data)
+    return data
+
+
+def validator(url):
+    """
+    Return a value that changes whenever the file at `url` does.
+    """
+    if url.startswith(("http://", "https://")):
+        return _head(url)
+    if os.path.exists(url):
+        st = os.stat(url)
+        return st.st_mtime, st.st_size
+    return None
+
+
+def chunk_ranges(path, columns=None, row_groups=None):
+    import pyarrow.parquet as pq
+
+    md = pq.read_metadata(path)
+    if row_groups is None:
+        row_groups = range(md.num_row_groups)
+    if columns is not None:
+        columns = set(columns)
+        if not columns:
+            # scans always touch at least one column
+            columns = {md.schema.column(0).path.split(".")[0]}
+    ranges = []
+    for i in row_groups:
+        rg = md.row_group(i)
+        for j in range(rg.num_columns):
+            col = rg.column(j)
+            if columns is not None and col.path_in_schema.split(".")[0] not in columns:
+                continue
+            start = col.data_page_offset
+            if col.has_dictionary_page and col.dictionary_page_offset:
+                start = min(start, col.dictionary_page_offset)
+            ranges.append((start, start + col.total_compressed_size))
+    return ranges
+
+
+def evict(max_bytes=MAX_BYTES, keep=None):
+    entries = []
+    for name in os.listdir(CACHE_DIR):
+        if name.endswith(".parquet"):
+            path = os.path.join(CACHE_DIR, name)
+            st = os.stat(path)
+            # sparse files only occupy the blocks that were fetched
+            entries.append((st.st_mtime, st.st_blocks * 512, path))
+    total = sum(size for _, size, _ in entries)
+    for _mtime, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        if path == keep:
+            continue
+        base = path[: -len(".parquet")]
+        with _locked(base + ".lock", blocking=False) as acquired:
+            if not acquired:
+                continue
+            with _locked(base + ".pin", blocking=False) as unpinned:
+                if not unpinned:
+                    # still in use by a running task
+                    continue
+                for victim in (path, base + ".json"):
+                    if os.path.exists(victim):
+                        os.unlink(victim)
+                total -= size
+
+
+@contextmanager
+def _locked(path, blocking=True):
+    with open(path, "a") as f:
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def _pin(path):
+    # taken while the entry's lock is held, so eviction can't come between
+    if path not in _pins:
+        f = open(path, "a")
+        fcntl.flock(f, fcntl.LOCK_SH)
+        _pins[path] = f
+
+
+def _head(url):
+    req = urllib.request.Request(url, method="HEAD")
+    with urllib.request.urlopen(req) as resp:
+        validator = resp.headers.get("ETag") or resp.headers.get("Last-Modified")
+        return validator, int(resp.headers["Content-Length"])
+
+
+def _load(meta):
+    try:
+        with open(meta) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _save(meta, state):
+    tmp = f"{meta}.{os.getpid()}.tmp"
+    with open(tmp, "w") as f:
+        json.dump(state, f)
+    os.replace(tmp, meta)
+
+
+def _merge(ranges, gap=0):
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1] + gap:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return merged
+
+
+def _missing(wanted, have):
+    missing = []
+    for start, end in _merge(wanted):
+        for h_start, h_end in have:
+            if h_end <= start or h_start >= end:
+                continue
+            if h_start > start:
+                missing.append((start, h_start))
+            start = max(start, h_end)
+        if start < end:
+            missing.append((start, end))
+    return missing
+
+
+def _footer_range(path, size):
+    with open(path, "rb") as f:
+        f.seek(size - 8)
+        tail = f.read(8)
+    if tail[4:] != b"PAR1":
+        raise Exception("not a parquet file: %s" % path)
+    return size - 8 - int.from_bytes(tail[:4], "little"), size
+
+
+def _ensure(data, meta, state, wanted):
+    missing = _missing(wanted, state["ranges"])
+    if not missing:
+        return
+    with open(data, "r+b") as f:
+        for start, end in _merge(missing, gap=COALESCE_GAP):
+            whole = _fetch(state["url"], start, end, state["validator"], f)
+            state["ranges"] = _merge(
+                state["ranges"] + [[0, state["size"]] if whole else [start, end]]
+            )
+            _save(meta, state)
+            if whole:
+                break
+
+
+def _fetch(url, start, end, validator, f):
+    headers = {"Range": "bytes=%d-%d" % (start, end - 1)}
+    if validator:
+        headers["If-Range"] = validator
+    with urllib.request.urlopen(urllib.request.Request(url, headers=headers)) as resp:
+        # a 200 means the server ignored the range (or the file changed
+        # under If-Range), so the body is the whole file
+        whole = resp.status == 200
+        f.seek(0 if whole else start)
+        while True:
+            buf = resp.read(1024**2)
+            if not buf:
+                break
+            f.write(buf)
+        if whole:
+            f.truncate()
+    return whole
@@ -0,0 +1,37 @@
+from metaflow import FlowSpec, step, pypi, Config
+
+from dataset import dataset, merge_tables, arrow_tables, DEPS
+
+class PartitionedDatasetFlow(FlowSpec):
+
+    data_config = Config('dataset', default='dataset.json')
+
+    @dataset(url=data_config.url, partitions=4)
+    @step
+    def start(self):
+        print(f"Scanning {len(self.partitions)} partitions")
+        self.next(self.scan, foreach='partitions')
+
+    @dataset(url=data_config.url, filter=data_config.filter, partitioned=True)
+    @step
+    def scan(self):
+        print(f"Partition {self.input['index']}: {len(self.table)} rows")
+        self.part = self.table
+        self.next(self.join)
+
+    @arrow_tables
+    @pypi(packages=DEPS)
+    @step
+    def join(self, inputs):
+        self.table = merge_tables(inputs, 'part')
+        print(self.table)
+        self.next(self.end)
+
+    @pypi(packages=DEPS)
+    @step
+    def end(self):
+        # stored as an Arrow IPC file and memory-mapped on access
+        print(f"{len(self.table)} rows in {self.table.column_names}")
+
+if __name__ == '__main__':
+    PartitionedDatasetFlow()
@@ -1,14 +1,182 @@
+import copy
+import time
+import random
 from metaflow import user_step_decorator, current
 
 @user_step_decorator
 def fallback(step_name, flow, inputs=None, attributes=None):
-    def _fallback_step(self):
+    def _fallback_step(self, *args):
         print("🛟 step failed: executing a fallback")
         var = attributes.get('indicator')
         if var:
             setattr(self, var, True)
+        # Metaflow calls the self.next of the step this replaces
+        return True
 
-    if current.retry_count == 0:
+    policies = attributes.get('policies')
+    if not policies:
+        if current.retry_count == 0:
+            yield
+        else:
+            yield _fallback_step
+        return
+
+    base = float(attributes.get('backoff', 2))
+    cap = float(attributes.get('max_backoff', 60))
+    budget = attributes.get('budget')
+    inprocess = attributes.get('inprocess')
+
+    def _give_up(ex, attempt, started):
+        # decided on the live exception, so its whole MRO is matched on
+        # every attempt, including the relaunched ones
+        allowed = retries_for(policies, type(ex))
+        if allowed == 0:
+            # retrying a deterministic failure would fail the same way
+            print(f"🛟 {type(ex).__name__} is not retriable: {ex}")
+            return True
+        if attempt >= allowed:
+            print(f"🛟 giving up on {type(ex).__name__} after {attempt + 1} attempts")
+            return True
+        if budget and time.time() - started >= float(budget):
+            print(f"⏳ retry budget of {budget}s exhausted after {time.time() - started:.0f}s")
+            return True
+        return False
+
+    def _guarded_step(self, *args):
+        snapshot = Snapshot(self)
+        started = time.time()
+        attempt = 0
+        while True:
+            try:
+                return step(*args)
+            except MemoryError:
+                # the process may be left in a bad state: relaunch the task
+                raise
+            except Exception as ex:
+                snapshot.restore(self)
+                if _give_up(ex, attempt, started):
+                    return _fallback_step(self, *args)
+                attempt += 1
+                delay = backoff(attempt, base, cap)
+                print(
+                    f"🔁 retrying in-process after {type(ex).__name__}: "
+                    f"attempt {attempt}, waiting {delay:.1f}s"
+                )
+                time.sleep(delay)
+
+    step = getattr(flow, step_name)
+    inner = inner_wrappers(flow, step_name)
+    if inprocess and inner:
+        # re-running only the step body would skip them, so this step is
+        # retried by relaunching the task instead
+        if current.retry_count == 0:
+            print(f"🔁 in-process retries are off for {step_name}: it has {', '.join(inner)}")
+    elif inprocess:
+        if current.retry_count == 0:
+            yield _guarded_step
+            return
+        # other failures were retried in-process, so only a crash or an
+        # out-of-memory error relaunches the task
+        crash_retries = int(attributes.get('crash_retries', 1))
+        if current.retry_count <= crash_retries:
+            print(f"🔁 relaunched after a crash or MemoryError: attempt {current.retry_count}")
+            yield _guarded_step
+        else:
+            yield _fallback_step
+        return
+
+    started = time.time()
+    if current.retry_count:
+        if current.retry_count > max(int(n) for n in policies.values()):
+            # the previous attempt crashed on its last allowed retry
+            yield _fallback_step
+            return
+        started = first_attempt_started() or started
+        delay = backoff(current.retry_count, base, cap)
+        if budget:
+            delay = min(delay, max(0.0, float(budget) - (time.time() - started)))
+        print(f"🔁 retrying: attempt {current.retry_count}, waiting {delay:.1f}s")
+        time.sleep(delay)
+
+    # the step runs through every decorator inside this one; failures are
+    # caught here and either relaunch the task through @retry or are
+    # swallowed in favour of the fallback
+    snapshot = Snapshot(flow)
+    try:
         yield
-    else:
-        yield _fallback_step
+    except MemoryError:
+        raise
+    except Exception as ex:
+        if not _give_up(ex, current.retry_count, started):
+            raise
+        snapshot.restore(flow)
+        _fallback_step(flow)
+
+class Snapshot(object):
+    """
+    The artifacts set on the flow before the step ran, used to undo a
+    failed attempt before the step body runs again. Mutable containers are
+    copied, anything else is assumed to be replaced rather than mutated.
+    """
+
+    def __init__(self, flow):
+        self.transition = getattr(flow, "_transition", None)
+        self.artifacts = {
+            name: _copy(value)
+            for name, value in vars(flow).items()
+            if not name.startswith("_")
+        }
+
+    def restore(self, flow):
+        for name in [n for n in vars(flow) if not n.startswith("_")]:
+            if name not in self.artifacts:
+                # input artifacts are reloaded from the datastore on access
+                delattr(flow, name)
+        for name, value in self.artifacts.items():
+            setattr(flow, name, _copy(value))
+        flow._transition = self.transition
+
+def _copy(value):
+    if isinstance(value, (list, dict, set, bytearray)):
+        try:
+            return copy.deepcopy(value)
+        except Exception:
+            pass
+    return value
+
+def retries_for(policies, error):
+    """
+    Number of retries allowed for an exception class: the policy of the
+    closest class in its MRO, 0 if none matches.
+    """
+    for name in [cls.__name__ for cls in error.__mro__]:
+        if name in policies:
+            return int(policies[name])
+    return 0
+
+def inner_wrappers(flow, step_name):
+    """
+    Names of the user decorators that run inside this one on the step.
+    """
+    wrappers = getattr(getattr(flow.__class__, step_name), "wrappers", [])
+    names = [getattr(w, "_decorator_name", type(w).__name__) for w in wrappers]
+    own = f"{__name__}.fallback"
+    # the outermost decorator comes last
+    return names[: names.index(own)] if own in names else []
+
+def backoff(attempt, base, cap):
+    # exponential backoff with full jitter
+    return random.uniform(0, min(cap, base * 2 ** (attempt - 1)))
+
+def first_attempt_started():
+    """
+    When the first attempt of this task started, as a timestamp, or None
+    if the metadata service doesn't know.
+    """
+    from metaflow import Task
+
+    try:
+        created = Task(current.pathspec, attempt=0).created_at
+        return created.timestamp()
+    except Exception:
+        return None
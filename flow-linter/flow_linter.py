@@ -1,22 +1,382 @@
+import os
+import json
+import hashlib
+from collections.abc import Mapping
+
 from metaflow import FlowMutator, config_expr, current
 
+CACHE_DIR = os.environ.get(
+    "FLOW_LINTER_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".metaflow_flow_linter")
+)
+# bump when the checks change, so cached results are not reused
+CACHE_VERSION = 2
+MAX_ENTRIES = 10000
+
+DECORATORS = ("kubernetes", "batch", "resources")
+# resources considered when packing tasks onto nodes, and the values
+# Metaflow uses when no decorator sets them (memory and disk in MB)
+PACKED = ("cpu", "memory", "disk")
+DEFAULTS = {"cpu": 1, "memory": 4096, "disk": 10240}
+# keys of the limits config that are not attribute rules
+RESERVED = ("decorators", "require", "steps")
+
+# compiled rules, keyed by the digest of the limits config
+_RULES = {}
+
 
 class flow_linter(FlowMutator):
+    """
+    Checks the resource decorators of every step against the `limits`
+    config. A limit is either a number (the maximum, as before) or a rule
+    like {"min": 1024, "max": 16000} or {"allowed": [0, 1, 2]}. The config
+    may also list decorators every step must have under "require", and
+    rules for individual steps under "steps", e.g. {"steps": {"train":
+    {"cpu": 8}}}. The result of checking a step is cached against its
+    decorator specs, so only steps that changed are checked again.
+
+    With `nodes`, requests are also rounded so tasks pack onto the given
+    node shapes without stranding capacity, and a report of the nodes
+    needed by each step's fan-out is printed.
+    """
+
+    def init(self, *args, **kwargs):
+        # node shapes to pack the resource requests onto: a dict or the
+        # path of a JSON file, see nodes.json
+        self.nodes = kwargs.get("nodes")
+
     def mutate(self, mutable_flow):
-        limits = mutable_flow.limits
+        nodes = self.nodes
+        if isinstance(nodes, str):
+            with open(nodes) as f:
+                nodes = json.load(f)
+        rules = compile_rules(mutable_flow.limits, nodes)
+        cache = LintCache(rules.digest)
+        packed = {}
         for step_name, step in mutable_flow.steps:
-            for deco_name, _module, _args, attributes in step.decorator_specs:
-                if deco_name in ("kubernetes", "batch", "resources"):
-                    for key, limit in limits.items():
-                        val = attributes.get(key)
-                        if val and float(val) > limit:
-                            print(
-                                f"⚠️  Step[{step_name}] @{deco_name}({key}={val}) "
-                                f"is higher than the limit of {limit} - fixed"
-                            )
-                            attributes[key] = limit
-                            step.add_decorator(
-                                deco_name,
-                                deco_kwargs=attributes,
-                                duplicates=step.OVERRIDE,
-                            )
+            specs = list(step.decorator_specs)
+            key = digest([step_name, specs])
+            result = cache.get(key)
+            if result is None:
+                result = cache[key] = rules.check(step_name, specs)
+            for message in result["messages"]:
+                print(message)
+            attributes = {deco_name: attrs for deco_name, _module, _args, attrs in specs}
+            for deco_name, fixed in result["fixes"]:
+                step.add_decorator(
+                    deco_name,
+                    deco_kwargs=dict(attributes[deco_name], **fixed),
+                    duplicates=step.OVERRIDE,
+                )
+            for deco_name, kwargs in result["require"]:
+                step.add_decorator(deco_name, deco_kwargs=kwargs, duplicates=step.IGNORE)
+            if result.get("packing"):
+                packed[step_name] = result["packing"]
+        cache.save()
+        if rules.packing:
+            print_packing(packed, rules.packing["fanout"])
+
+
+def compile_rules(limits, nodes=None):
+    limits, nodes = plain(limits), plain(nodes)
+    key = digest([CACHE_VERSION, limits, nodes])
+    if key not in _RULES:
+        _RULES[key] = Rules(limits, key, nodes)
+    return _RULES[key]
+
+
+class Rules(object):
+    def __init__(self, limits, digest, nodes=None):
+        self.digest = digest
+        self.decorators = tuple(limits.get("decorators", DECORATORS))
+        self.packing = compile_nodes(nodes) if nodes else None
+        overrides = limits.get("steps", {})
+        base = {k: v for k, v in limits.items() if k != "steps"}
+        self.default = compile_step(base)
+        # a step's entry replaces the global rule for each key it sets
+        self.steps = {
+            step_name: compile_step(dict(base, **override))
+            for step_name, override in overrides.items()
+        }
+
+    def check(self, step_name, specs):
+        checks, require = self.steps.get(step_name, self.default)
+        messages, fixes = [], {}
+        present = set()
+        checked = {}
+        for deco_name, _module, _args, attributes in specs:
+            present.add(deco_name)
+            if deco_name not in self.decorators:
+                continue
+            checked[deco_name] = attributes
+            fixed = fixes[deco_name] = {}
+            for key, rule in checks.items():
+                val = attributes.get(key)
+                if val is None or val == "":
+                    continue
+                new_val, problem = apply_rule(rule, val)
+                if problem is None:
+                    continue
+                if new_val is None:
+                    raise Exception(
+                        f"Step[{step_name}] @{deco_name}({key}={val}) {problem}"
+                    )
+                messages.append(
+                    f"⚠️  Step[{step_name}] @{deco_name}({key}={val}) {problem} - fixed"
+                )
+                fixed[key] = _num(new_val)
+        packing = None
+        if self.packing and checked:
+            packing = self.pack(step_name, checked, fixes, messages)
+        missing = [[name, kwargs] for name, kwargs in require.items() if name not in present]
+        for name, _kwargs in missing:
+            messages.append(f"⚠️  Step[{step_name}] is missing @{name} - added")
+        return {
+            "messages": messages,
+            "fixes": [[deco_name, fixed] for deco_name, fixed in fixes.items() if fixed],
+            "require": missing,
+            "packing": packing,
+        }
+
+    def pack(self, step_name, checked, fixes, messages):
+        """
+        Round the step's request down to a share of the node shape it packs
+        best onto, if that is within the tolerance, and return the shape and
+        the number of tasks that fit on a node.
+        """
+        values = {}
+        for deco_name, attributes in checked.items():
+            for dim in PACKED:
+                val = fixes[deco_name].get(dim, attributes.get(dim))
+                if _is_number(val):
+                    values.setdefault(dim, {})[deco_name] = float(val)
+        # the task gets the largest of the values set by its decorators
+        request = {
+            dim: max(values[dim].values()) if dim in values else DEFAULTS[dim]
+            for dim in PACKED
+        }
+        best = best_fit(request, self.packing["shapes"], self.packing["tolerance"])
+        if best is None:
+            messages.append(
+                f"⚠️  Step[{step_name}] requests more than any node provides: "
+                + ", ".join(f"{dim}={_fmt(request[dim])}" for dim in PACKED)
+            )
+            return None
+        shape, per_node, rounded = best
+        for dim in PACKED:
+            if rounded[dim] >= request[dim]:
+                continue
+            # decorators that don't set the value get it if it's the default
+            targets = values.get(dim) or {next(iter(checked)): request[dim]}
+            for deco_name, val in targets.items():
+                if val > rounded[dim]:
+                    fixes[deco_name][dim] = _num(rounded[dim])
+                    messages.append(
+                        f"📦 Step[{step_name}] @{deco_name}({dim}={_fmt(val)}) "
+                        f"rounded to {_fmt(rounded[dim])} to fit {per_node} tasks per {shape}"
+                    )
+        return {"shape": shape, "per_node": per_node}
+
+
+def compile_step(limits):
+    require = limits.get("require") or {}
+    if isinstance(require, (list, tuple)):
+        require = {name: {} for name in require}
+    checks = {
+        key: compile_rule(key, rule) for key, rule in limits.items() if key not in RESERVED
+    }
+    return checks, require
+
+
+def compile_rule(key, rule):
+    if not isinstance(rule, dict):
+        # a plain number is a maximum
+        rule = {"max": rule}
+    unknown = set(rule) - {"min", "max", "allowed"}
+    if unknown:
+        raise Exception(
+            "flow_linter: unknown rule %s for %s, expected min, max or allowed"
+            % (", ".join(sorted(unknown)), key)
+        )
+    lo, hi, allowed = rule.get("min"), rule.get("max"), rule.get("allowed")
+    if allowed is not None and all(_is_number(v) for v in allowed):
+        allowed = sorted(float(v) for v in allowed)
+    return (
+        None if lo is None else float(lo),
+        None if hi is None else float(hi),
+        allowed,
+    )
+
+
+def apply_rule(rule, val):
+    """
+    Return the fixed value and what was wrong with `val`, (val, None) if
+    nothing was, or (None, problem) if there is no value to fix it to.
+    """
+    lo, hi, allowed = rule
+    if not _is_number(val):
+        if allowed is not None and val not in allowed:
+            return None, "is not one of %s" % ", ".join(map(str, allowed))
+        return val, None
+    num = float(val)
+    if hi is not None and num > hi:
+        return hi, f"is higher than the limit of {_fmt(hi)}"
+    if lo is not None and num < lo:
+        return lo, f"is lower than the minimum of {_fmt(lo)}"
+    if allowed is not None and num not in allowed:
+        if not all(_is_number(v) for v in allowed):
+            return None, "is not one of %s" % ", ".join(map(str, allowed))
+        # round up to the next allowed value, or down to the largest one
+        up = [v for v in allowed if v >= num]
+        return (up[0] if up else allowed[-1]), "is not one of %s" % ", ".join(
+            map(_fmt, allowed)
+        )
+    return val, None
+
+
+def compile_nodes(nodes):
+    shapes = {}
+    reserved = nodes.get("reserved", {})
+    for name, shape in nodes["shapes"].items():
+        # what's left for tasks after the system and per-node daemons
+        alloc = {
+            dim: float(shape[dim]) - float(reserved.get(dim, 0))
+            for dim in PACKED
+            if dim in shape
+        }
+        if any(value <= 0 for value in alloc.values()):
+            raise Exception(f"flow_linter: node shape {name} has nothing left after reserved")
+        shapes[name] = alloc
+    if not shapes:
+        raise Exception("flow_linter: nodes must describe at least one node shape")
+    return {
+        "shapes": shapes,
+        "tolerance": float(nodes.get("tolerance", 0.05)),
+        "fanout": nodes.get("fanout", {}),
+    }
+
+
+def best_fit(request, shapes, tolerance):
+    """
+    The node shape on which tasks of this size leave the least of their
+    dominant resource unused, as (shape, tasks per node, rounded request).
+    """
+    best = None
+    for name, alloc in shapes.items():
+        fit = pack_onto(request, alloc, tolerance)
+        if fit is None:
+            continue
+        per_node, rounded = fit
+        used = max(per_node * rounded[dim] / alloc[dim] for dim in alloc)
+        if best is None or used > best[0] + 1e-9:
+            best = (used, name, per_node, rounded)
+    return best and best[1:]
+
+
+def pack_onto(request, alloc, tolerance):
+    per_dim = {dim: int(alloc[dim] // request[dim]) for dim in alloc if request[dim] > 0}
+    if not per_dim:
+        return None
+    per_node = min(per_dim.values())
+    rounded = dict(request)
+    # e.g. 16.1GB on a 32GB node fits one task: asking for 16GB fits two
+    shares = {}
+    for dim, n in per_dim.items():
+        if n == per_node:
+            share = _floor(dim, alloc[dim] / (per_node + 1))
+            if share <= 0 or request[dim] > share * (1 + tolerance):
+                shares = None
+                break
+            shares[dim] = share
+    if shares:
+        rounded.update(shares)
+        per_node += 1
+    if per_node == 0:
+        return None
+    return per_node, rounded
+
+
+def print_packing(packed, fanout):
+    print("📦 Node packing")
+    print(f"{'Step':<20}{'Node':<16}{'Tasks/node':<12}{'Fan-out':<10}{'Nodes':<8}")
+    for step_name, packing in packed.items():
+        width = fanout.get(step_name)
+        nodes = -(-int(width) // packing["per_node"]) if width else ""
+        print(
+            f"{step_name:<20}{packing['shape']:<16}{packing['per_node']:<12}"
+            f"{width or '':<10}{nodes:<8}"
+        )
+
+
+class LintCache(object):
+    """
+    Check results of steps, keyed by a digest of the step's name and
+    decorator specs, in a JSON file per set of rules.
+    """
+
+    def __init__(self, rules_digest):
+        self.path = os.path.join(CACHE_DIR, rules_digest + ".json")
+        self.dirty = False
+        try:
+            with open(self.path) as f:
+                self.entries = json.load(f)
+        except (OSError, ValueError):
+            self.entries = {}
+
+    def get(self, key):
+        return self.entries.get(key)
+
+    def __setitem__(self, key, result):
+        self.entries[key] = result
+        self.dirty = True
+
+    def save(self):
+        if not self.dirty:
+            return
+        # drop the oldest entries first
+        keys = list(self.entries)[-MAX_ENTRIES:]
+        try:
+            os.makedirs(CACHE_DIR, exist_ok=True)
+            tmp = f"{self.path}.{os.getpid()}.tmp"
+            with open(tmp, "w") as f:
+                json.dump({k: self.entries[k] for k in keys}, f)
+            os.replace(tmp, self.path)
+        except OSError:
+            # the cache is only an optimization
+            pass
+
+
+def digest(value):
+    data = json.dumps(value, sort_keys=True, default=str)
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()[:32]
+
+
+def plain(value):
+    # Config values are read-only mappings
+    if isinstance(value, Mapping):
+        return {k: plain(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [plain(v) for v in value]
+    return value
+
+
+def _is_number(val):
+    try:
+        float(val)
+        return True
+    except (TypeError, ValueError):
+        return False
+
+
+def _num(num):
+    return int(num) if float(num).is_integer() else num
+
+
+def _floor(dim, value):
+    # memory and disk are whole MB, cpu is rounded to a tenth of a core
+    if dim == "cpu":
+        return int(value * 10) / 10
+    return float(int(value))
+
+
+def _fmt(num):
+    return str(int(num)) if float(num).is_integer() else str(num)
@@ -2,7 +2,7 @@ from metaflow import FlowSpec, step, resources, Config
 
 from flow_linter import flow_linter
 
-@flow_linter
+@flow_linter(nodes='nodes.json')
 class HungryFlow(FlowSpec):
 
     limits = Config('limits', default='limits.json')
@@ -1,21 +1,126 @@
-import os
-from metaflow import Flow, user_step_decorator, current
+import json
+import pickle
+import inspect
+import hashlib
+from collections import namedtuple
+from collections.abc import Mapping
+
+from metaflow import user_step_decorator, current
+
+from memostore import MemoIndex
+
+MISSING = object()
+
+MemoizeStats = namedtuple("MemoizeStats", ["key", "hit", "hits", "misses"])
+
 
 @user_step_decorator
 def memoize(step_name, flow, inputs=None, attributes=None):
-    artifact = attributes['artifact']
+    artifacts = attributes.get('artifacts') or [attributes['artifact']]
+    if isinstance(artifacts, str) and artifacts != "*":
+        artifacts = [artifacts]
     reset = attributes.get('reset')
+    max_size_mb = attributes.get('max_size_mb')
+    index = MemoIndex(
+        backend=attributes.get('backend', 'local'),
+        ttl=attributes.get('ttl'),
+        max_bytes=max_size_mb and int(max_size_mb) * 1024**2,
+    )
+    keys = attributes.get('keys') or []
+    if isinstance(keys, str):
+        keys = [keys]
+    keys = set(keys) | set(parameter_names(flow, exclude=reset))
+    key = cache_key(
+        step_name, flow, keys, foreach_input(flow), input_artifacts(flow, inputs)
+    )
     if reset and getattr(flow, reset, False):
         print("⚙️  memoized results disabled - running the step")
-        yield
+        cached = None
     else:
-        try:
-            run = Flow(current.flow_name).latest_successful_run
-            previous_value = run[step_name].task[artifact].data
-        except:
+        cached = index.get(key)
+        if cached is None:
             print("⚙️ previous results not found - running the step")
-            yield
+    current._update_env(
+        {"memoize": MemoizeStats(key, cached is not None, *index.stats())}
+    )
+    if cached is None:
+        before = dict(vars(flow))
+        yield
+        if artifacts == "*":
+            exclude = set(parameter_names(flow))
+            produced = {
+                name: value
+                for name, value in vars(flow).items()
+                if not name.startswith("_")
+                and name not in exclude
+                and before.get(name, MISSING) is not value
+            }
         else:
-            print(f"✅ reusing results from a previous run {run.id}")
-            setattr(flow, artifact, previous_value)
-            yield {}
+            produced = {name: getattr(flow, name) for name in artifacts}
+        index.put(key, produced)
+    else:
+        print(f"✅ reusing memoized results [{key[:12]}]")
+        for name, value in cached.items():
+            setattr(flow, name, value)
+        yield {}
+
+
+def parameter_names(flow, exclude=None):
+    # by the time a task runs, Metaflow has replaced the Parameters on the
+    # class with properties, so their names come from the flow itself
+    return [name for name, _param in flow._get_parameters() if name != exclude]
+
+
+def foreach_input(flow):
+    # keyed by the split's value rather than its index, so reordered or
+    # newly added splits still hit the cache
+    try:
+        return flow.input
+    except Exception:
+        return None
+
+
+def input_artifacts(flow, inputs=None):
+    """
+    Names and content hashes of the artifacts the step starts from, as
+    stored by the upstream tasks, so a change upstream misses the cache.
+    Parameters are keyed by value instead, and a foreach's list by the
+    split's own value.
+    """
+    exclude = set(parameter_names(flow))
+    exclude.update(frame.var for frame in getattr(flow, "_foreach_stack", None) or [])
+    datastores = [inp._datastore for inp in inputs] if inputs else [flow._datastore]
+    return [
+        sorted(
+            (name, sha)
+            for name, sha in getattr(ds, "_objects", {}).items()
+            if not name.startswith("_") and name not in exclude
+        )
+        for ds in datastores
+    ]
+
+
+def cache_key(step_name, flow, keys, split=None, artifacts=None):
+    sha = hashlib.sha256()
+    sha.update(f"{current.flow_name}.{step_name}".encode("utf-8"))
+    sha.update(inspect.getsource(getattr(flow, step_name)).encode("utf-8"))
+    sha.update(fingerprint(split).encode("utf-8"))
+    sha.update(fingerprint(artifacts).encode("utf-8"))
+    for name in sorted(keys):
+        sha.update(name.encode("utf-8"))
+        sha.update(fingerprint(getattr(flow, name, None)).encode("utf-8"))
+    return sha.hexdigest()
+
+
+def fingerprint(value):
+    def _canonical(x):
+        if isinstance(x, Mapping):
+            return {str(k): _canonical(v) for k, v in x.items()}
+        if isinstance(x, (list, tuple)):
+            return [_canonical(v) for v in x]
+        return x
+
+    def _digest(x):
+        return hashlib.sha256(pickle.dumps(x, protocol=4)).hexdigest()
+
+    return json.dumps(_canonical(value), sort_keys=True, default=_digest)
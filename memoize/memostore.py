@@ -0,0 +1,161 @@
+import os
+import time
+import pickle
+
+CACHE_DIR = os.environ.get(
+    "MEMOIZE_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".metaflow_memoize")
+)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    key TEXT PRIMARY KEY,
+    location TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    created REAL NOT NULL,
+    accessed REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed);
+CREATE TABLE IF NOT EXISTS counters (
+    name TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+"""
+
+
+class LocalBackend(object):
+    def __init__(self, root):
+        self.root = os.path.join(root, "blobs")
+
+    def put(self, key, blob):
+        path = os.path.join(self.root, key[:2], key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(blob)
+        os.replace(tmp, path)
+        return path
+
+    def get(self, location):
+        with open(location, "rb") as f:
+            return f.read()
+
+    def delete(self, location):
+        try:
+            os.unlink(location)
+        except FileNotFoundError:
+            pass
+
+
+class S3Backend(object):
+    def __init__(self, root):
+        from metaflow.metaflow_config import DATASTORE_SYSROOT_S3
+
+        self.s3root = os.path.join(DATASTORE_SYSROOT_S3, "memoize")
+
+    def put(self, key, blob):
+        from metaflow import S3
+
+        with S3(s3root=self.s3root) as s3:
+            return s3.put(key, blob)
+
+    def get(self, location):
+        from metaflow import S3
+
+        with S3() as s3:
+            return s3.get(location).blob
+
+    def delete(self, location):
+        # leave object expiry to the bucket's lifecycle rules
+        pass
+
+
+BACKENDS = {"local": LocalBackend, "s3": S3Backend}
+
+
+class MemoIndex(object):
+    """
+    On-disk index mapping a cache key to the location of its pickled
+    artifacts in a backend. Entries expire after `ttl` seconds and the
+    least recently used ones are evicted once the total size exceeds
+    `max_bytes`.
+    """
+
+    def __init__(self, root=CACHE_DIR, backend="local", ttl=None, max_bytes=None):
+        import sqlite3
+
+        os.makedirs(root, exist_ok=True)
+        if isinstance(backend, str):
+            backend = BACKENDS[backend](root)
+        self.backend = backend
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.db = sqlite3.connect(
+            os.path.join(root, "index.db"), timeout=60, isolation_level=None
+        )
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.executescript(SCHEMA)
+
+    def get(self, key):
+        row = self.db.execute(
+            "SELECT location, created FROM entries WHERE key=?", (key,)
+        ).fetchone()
+        if row:
+            location, created = row
+            if self.ttl and time.time() - created > float(self.ttl):
+                self._evict([(key, location)])
+            else:
+                try:
+                    value = pickle.loads(self.backend.get(location))
+                except Exception:
+                    self._evict([(key, location)])
+                else:
+                    self.db.execute(
+                        "UPDATE entries SET accessed=? WHERE key=?", (time.time(), key)
+                    )
+                    self._incr("hits")
+                    return value
+        self._incr("misses")
+        return None
+
+    def put(self, key, value):
+        blob = pickle.dumps(value, protocol=4)
+        location = self.backend.put(key, blob)
+        now = time.time()
+        self.db.execute(
+            "INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?)",
+            (key, location, len(blob), now, now),
+        )
+        if self.max_bytes:
+            self._shrink()
+
+    def stats(self):
+        counts = dict(self.db.execute("SELECT name, value FROM counters"))
+        return counts.get("hits", 0), counts.get("misses", 0)
+
+    def _incr(self, name):
+        self.db.execute(
+            "INSERT INTO counters VALUES (?, 1) "
+            "ON CONFLICT(name) DO UPDATE SET value=value+1",
+            (name,),
+        )
+
+    def _shrink(self):
+        (total,) = self.db.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM entries"
+        ).fetchone()
+        if total <= self.max_bytes:
+            return
+        victims = []
+        for key, location, size in self.db.execute(
+            "SELECT key, location, size FROM entries ORDER BY accessed"
+        ).fetchall():
+            if total <= self.max_bytes:
+                break
+            victims.append((key, location))
+            total -= size
+        self._evict(victims)
+
+    def _evict(self, victims):
+        for key, location in victims:
+            self.db.execute("DELETE FROM entries WHERE key=?", (key,))
+            self.backend.delete(location)
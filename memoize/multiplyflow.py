@@ -0,0 +1,26 @@
+from metaflow import FlowSpec, step, Parameter
+
+from memoize import memoize
+
+class MultiplyFlow(FlowSpec):
+
+    mult = Parameter('mult', default=2, type=int)
+
+    @step
+    def start(self):
+        self.next(self.multiply)
+
+    @memoize(artifact='values')
+    @step
+    def multiply(self):
+        self.values = [self.mult * i for i in (1, 2, 3)]
+        self.next(self.end)
+
+    @step
+    def end(self):
+        # a changed --mult must miss the cache rather than reuse old values
+        assert self.values == [self.mult * i for i in (1, 2, 3)], self.values
+        print(f"Values: {self.values}")
+
+if __name__ == '__main__':
+    MultiplyFlow()
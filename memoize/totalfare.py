@@ -14,11 +14,13 @@ class ComputeTotalFare(FlowSpec):
         self.next(self.compute_fare)
 
     @memoize(artifact='total_fare', reset='reset')
-    @pypi(packages={'duckdb': '1.3.2'})
+    @pypi(packages={'duckdb': '1.3.2', 'pyarrow': '20.0.0'})
     @step
     def compute_fare(self):
         import duckdb
-        SQL = f"SELECT SUM(fare_amount) AS total_fare FROM '{self.url}'"
+        from parquet_cache import cached_path
+        path = cached_path(self.url, columns=['fare_amount'])
+        SQL = f"SELECT SUM(fare_amount) AS total_fare FROM '{path}'"
         self.total_fare = duckdb.query(SQL).fetchone()[0]
         self.next(self.end)
 
@@ -0,0 +1,36 @@
+"""
+A stand-in for the Argo Events webhook, to try @event_outbox locally:
+
+    python local_webhook.py 12000
+    EVENT_OUTBOX_URL=http://localhost:12000/ python parent_flow.py run
+
+Prints every event it receives and flags duplicate idempotency keys.
+"""
+import sys
+import json
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+seen = set()
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        key = body["payload"].get("idempotency_key")
+        duplicate = key is not None and key in seen
+        seen.add(key)
+        print(("🔁 duplicate " if duplicate else "📨 ") + json.dumps(body), flush=True)
+        self.send_response(200)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+if __name__ == "__main__":
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 12000
+    print(f"Listening on http://localhost:{port}/")
+    ThreadingHTTPServer(("", port), Handler).serve_forever()
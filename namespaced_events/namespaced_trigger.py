@@ -1,6 +1,17 @@
-from metaflow import FlowMutator
+from metaflow import FlowMutator, user_step_decorator
+import os
 import sys
 import re
+import json
+import time
+import hashlib
+import threading
+from contextlib import contextmanager
+
+# the outbox of the running task, set by @event_outbox
+_outbox = None
+# events held back for coalescing in the running task, set by @coalesce_events
+_pending = None
 
 
 class namespaced_trigger(FlowMutator):
@@ -124,9 +135,26 @@ class namespaced_trigger(FlowMutator):
             )
 
     @classmethod
-    def raise_event(cls, event_name, payload=None, safe_publish=False):
+    def raise_event(cls, event_name, payload=None, safe_publish=False, coalesce=False):
         from metaflow import current
-        from metaflow.integrations import ArgoEvent
+
+        if coalesce:
+            if _pending is None:
+                raise Exception(
+                    "raise_event(..., coalesce=True) requires @coalesce_events on the flow"
+                )
+            _pending.append(
+                {
+                    "name": event_name,
+                    "payload": dict(payload or {}),
+                    "safe_publish": safe_publish,
+                    "raised_at": time.time(),
+                    "origin": current.pathspec,
+                    # events of the same task can share a timestamp
+                    "seq": sum(1 for e in _pending if e["origin"] == current.pathspec),
+                }
+            )
+            return
 
         if "project_flow_name" in current:
             event_name = ".".join(
@@ -134,6 +162,13 @@ class namespaced_trigger(FlowMutator):
             )
             event_name = re.sub(r"[^a-zA-Z0-9_\-\.]", "", event_name)
 
+        if _outbox is not None:
+            # published in the background by @event_outbox
+            _outbox.put(event_name, payload, force=not safe_publish)
+            return
+
+        from metaflow.integrations import ArgoEvent
+
         if safe_publish:
             ArgoEvent(name=event_name).safe_publish(
                 payload=payload,
@@ -253,3 +288,394 @@ class namespaced_trigger(FlowMutator):
                 options=self.options,
             )
         )
+
+
+class coalesce_events(FlowMutator):
+    """
+    Coalesces the events a run raises with `raise_event(..., coalesce=True)`,
+    so that e.g. a foreach in which every split raises "food" triggers the
+    downstream flow once, with the payloads of all splits:
+
+        @coalesce_events(window=60, fan_in=100)
+        @project(name="foo")
+        class HelloFlowUpstream(FlowSpec):
+
+    Pending events are kept as an artifact, merged at joins, and published,
+    one event per name, at the end of the `end` step, or earlier when
+    `fan_in` events are pending or the oldest one has waited `window`
+    seconds. Each
+    merged event carries the run's `correlation_id`, a `count` and the list
+    of `payloads`, with the keys that all payloads share also set at the
+    top level so they can still be mapped to parameters of the downstream
+    flow. With `outbox` (True or the arguments of @event_outbox), merged
+    events are published through an event outbox.
+    """
+
+    def init(self, *args, **kwargs):
+        self.window = kwargs.get("window")
+        self.fan_in = kwargs.get("fan_in")
+        self.outbox = kwargs.get("outbox")
+
+    def mutate(self, mutable_flow):
+        for step_name, step in mutable_flow.steps:
+            step.add_decorator(
+                coalesced_events,
+                deco_kwargs={
+                    "window": self.window,
+                    "fan_in": self.fan_in,
+                    "outbox": self.outbox,
+                },
+                duplicates=step.IGNORE,
+            )
+
+
+@user_step_decorator
+def coalesced_events(step_name, flow, inputs=None, attributes=None):
+    global _pending
+    if inputs:
+        # splits share the events pending before the foreach: keep one copy
+        merged = {}
+        for inp in inputs:
+            for event in getattr(inp, "_pending_events", []):
+                merged[(event["origin"], event["seq"])] = event
+        pending = sorted(
+            merged.values(), key=lambda event: (event["raised_at"], event["origin"], event["seq"])
+        )
+    else:
+        pending = list(getattr(flow, "_pending_events", []))
+    _pending = pending
+    try:
+        yield
+    finally:
+        _pending = None
+    window, fan_in = attributes.get("window"), attributes.get("fan_in")
+    if pending and (
+        step_name == "end"
+        or (fan_in and len(pending) >= int(fan_in))
+        or (window and time.time() - pending[0]["raised_at"] >= float(window))
+    ):
+        publish_coalesced(pending, attributes.get("outbox"))
+        pending = []
+    flow._pending_events = pending
+
+
+def publish_coalesced(pending, outbox=None):
+    from metaflow import current
+
+    if outbox and _outbox is None:
+        # this runs after the step's own decorators are done, so it needs
+        # an outbox of its own
+        with outbox_scope(**(outbox if isinstance(outbox, dict) else {})):
+            publish_coalesced(pending)
+        return
+
+    correlation_id = "%s/%s" % (current.flow_name, current.run_id)
+    groups = {}
+    for event in pending:
+        groups.setdefault((event["name"], event["safe_publish"]), []).append(event["payload"])
+    for (name, safe_publish), payloads in groups.items():
+        shared = {
+            key: value
+            for key, value in payloads[0].items()
+            if all(key in p and p[key] == value for p in payloads[1:])
+        }
+        print(f"📦 Publishing {len(payloads)} coalesced {name} events")
+        namespaced_trigger.raise_event(
+            name,
+            payload=dict(
+                shared,
+                correlation_id=correlation_id,
+                count=len(payloads),
+                payloads=json.dumps(payloads, default=str),
+            ),
+            safe_publish=safe_publish,
+        )
+
+
+@user_step_decorator
+def event_outbox(step_name, flow, inputs=None, attributes=None):
+    """
+    Queues the events raised with `namespaced_trigger.raise_event` during
+    the step and publishes them from a background thread over a single
+    keep-alive connection, instead of blocking on a request per event.
+    The end of a successful step waits up to `flush_timeout` seconds for
+    the events to go out.
+
+    Every event carries an idempotency key derived from the task and its
+    position in the step. Keys that were sent, and events left unsent,
+    are kept in the flow's datastore, so a retry of the task on other
+    compute doesn't publish them again. Events go to `url`,
+    $EVENT_OUTBOX_URL or the Argo Events webhook.
+    """
+    with outbox_scope(
+        url=attributes.get("url"),
+        batch_size=int(attributes.get("batch_size", 100)),
+        flush_timeout=float(attributes.get("flush_timeout", 30)),
+    ):
+        yield
+
+
+@contextmanager
+def outbox_scope(url=None, batch_size=100, flush_timeout=30):
+    global _outbox
+    from metaflow import current
+
+    outbox = EventOutbox(current.pathspec, url=url, batch_size=batch_size)
+    _outbox = outbox
+    try:
+        yield outbox
+    except BaseException:
+        _outbox = None
+        # the step failed already: don't hold up reporting it
+        unsent = outbox.close(0)
+        if unsent:
+            print(
+                f"⚠️  {unsent} events not published yet, they stay in {outbox.store.root} "
+                "for the next attempt",
+                file=sys.stderr,
+            )
+        raise
+    _outbox = None
+    unsent = outbox.close(flush_timeout)
+    if unsent:
+        # a successful attempt has no next attempt to send them, so fail
+        # it; a retry re-raises the same events and sends the spooled ones
+        raise Exception(
+            f"{unsent} events were not published within {flush_timeout}s, "
+            f"they stay in {outbox.store.root}"
+        )
+    outbox.clear()
+
+
+class OutboxStore(object):
+    """
+    The sent keys and unsent events of a task, next to the flow's
+    datastore under its pathspec, which stays the same across attempts,
+    so a retry in a fresh pod finds them too.
+    """
+
+    def __init__(self, pathspec):
+        from metaflow.metaflow_config import (
+            DEFAULT_DATASTORE,
+            DATASTORE_SYSROOT_LOCAL,
+            DATASTORE_SYSROOT_S3,
+        )
+
+        self.s3 = DEFAULT_DATASTORE == "s3"
+        if self.s3:
+            self.root = os.path.join(DATASTORE_SYSROOT_S3, "event_outbox", pathspec)
+        else:
+            root = DATASTORE_SYSROOT_LOCAL or os.path.join(os.getcwd(), ".metaflow")
+            self.root = os.path.join(root, "event_outbox", pathspec)
+
+    def put(self, name, text):
+        if self.s3:
+            from metaflow import S3
+
+            with S3(s3root=self.root) as s3:
+                s3.put(name, text)
+            return
+        os.makedirs(self.root, exist_ok=True)
+        path = os.path.join(self.root, name)
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "w") as f:
+            f.write(text)
+        os.replace(tmp, path)
+
+    def get(self, name):
+        if self.s3:
+            from metaflow import S3
+
+            with S3(s3root=self.root) as s3:
+                obj = s3.get(name, return_missing=True)
+                return obj.text if obj.exists else ""
+        try:
+            with open(os.path.join(self.root, name)) as f:
+                return f.read()
+        except FileNotFoundError:
+            return ""
+
+    def delete(self, name):
+        if self.s3:
+            # metaflow.S3 can't delete objects
+            self.put(name, "")
+            return
+        try:
+            os.unlink(os.path.join(self.root, name))
+        except FileNotFoundError:
+            pass
+
+
+class EventOutbox(object):
+    def __init__(self, pathspec, url=None, batch_size=100):
+        from metaflow.metaflow_config import (
+            ARGO_EVENTS_WEBHOOK_AUTH,
+            ARGO_EVENTS_WEBHOOK_URL,
+            SERVICE_HEADERS,
+        )
+
+        self.url = url or os.environ.get("EVENT_OUTBOX_URL")
+        # like ArgoEvent.safe_publish, only publish outside of Argo
+        # Workflows when asked to or when sending to a given endpoint
+        self.publish_all = bool(self.url) or bool(os.environ.get("ARGO_WORKFLOW_TEMPLATE"))
+        self.url = self.url or ARGO_EVENTS_WEBHOOK_URL
+        self.headers = {"Content-Type": "application/json"}
+        if ARGO_EVENTS_WEBHOOK_AUTH == "service":
+            self.headers.update(SERVICE_HEADERS)
+        self.batch_size = batch_size
+        self.pathspec = pathspec
+        self.seq = 0
+        self.store = OutboxStore(pathspec)
+        self.sent = set(self.store.get("sent").split())
+        # events a previous attempt spooled but didn't get to send
+        self.queue = [
+            event for event in _parse_events(self.store.get("spool.jsonl"))
+            if event["key"] not in self.sent
+        ]
+        self.known = self.sent | {event["key"] for event in self.queue}
+        self.conn = None
+        self.closed = False
+        self.cleared = False
+        self.cond = threading.Condition()
+        # orders the sender's ledger writes with close() and clear()
+        self.store_lock = threading.Lock()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def put(self, name, payload=None, force=True):
+        self.seq += 1
+        payload = dict(payload or {})
+        key = hashlib.sha256(
+            json.dumps([self.pathspec, self.seq, name, payload], sort_keys=True, default=str).encode(
+                "utf-8"
+            )
+        ).hexdigest()[:32]
+        if key in self.known:
+            # raised by a previous attempt of this task
+            return key
+        if not self.url:
+            print(
+                "Unable to publish Argo Event (%s): no webhook URL configured" % name,
+                file=sys.stderr,
+            )
+            return key
+        if not (force or self.publish_all):
+            print(
+                "Argo Event (%s) was not published. Use "
+                "raise_event(..., safe_publish=False) to force publish." % name,
+                file=sys.stderr,
+            )
+            return key
+        event = {
+            "key": key,
+            "body": {
+                "name": name,
+                "payload": {
+                    "name": name,
+                    "id": key,
+                    "idempotency_key": key,
+                    "timestamp": int(time.time()),
+                    "utc_date": time.strftime("%Y%m%d", time.gmtime()),
+                    "generated-by-metaflow": True,
+                    **payload,
+                },
+            },
+        }
+        self.known.add(key)
+        with self.cond:
+            self.queue.append(event)
+            self.cond.notify_all()
+        return key
+
+    def close(self, timeout):
+        """
+        Wait up to `timeout` seconds for the queued events to be sent,
+        store the ones that were not for the next attempt and return how
+        many there are.
+        """
+        deadline = time.time() + timeout
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+            while self.queue and time.time() < deadline:
+                self.cond.wait(deadline - time.time())
+            unsent = list(self.queue)
+        if unsent:
+            with self.store_lock:
+                self.store.put(
+                    "spool.jsonl", "".join(json.dumps(e, default=str) + "\n" for e in unsent)
+                )
+        return len(unsent)
+
+    def clear(self):
+        with self.store_lock:
+            self.cleared = True
+            for name in ("spool.jsonl", "sent"):
+                self.store.delete(name)
+
+    def _run(self):
+        failures = 0
+        while True:
+            with self.cond:
+                while not self.queue and not self.closed:
+                    self.cond.wait()
+                if not self.queue:
+                    return
+                batch = self.queue[: self.batch_size]
+            sent = self._send(batch)
+            with self.cond:
+                del self.queue[: len(sent)]
+                self.sent.update(sent)
+                ledger = "".join(key + "\n" for key in sorted(self.sent))
+                self.cond.notify_all()
+            if sent:
+                with self.store_lock:
+                    if not self.cleared:
+                        self.store.put("sent", ledger)
+            if len(sent) < len(batch):
+                failures += 1
+                time.sleep(min(30, 2 ** failures))
+            else:
+                failures = 0
+
+    def _send(self, batch):
+        import http.client
+        from urllib.parse import urlsplit
+
+        url = urlsplit(self.url)
+        sent = []
+        for event in batch:
+            try:
+                if self.conn is None:
+                    cls = (
+                        http.client.HTTPSConnection
+                        if url.scheme == "https"
+                        else http.client.HTTPConnection
+                    )
+                    self.conn = cls(url.netloc, timeout=60)
+                self.conn.request(
+                    "POST",
+                    url.path or "/",
+                    body=json.dumps(event["body"], default=str).encode("utf-8"),
+                    headers=self.headers,
+                )
+                resp = self.conn.getresponse()
+                resp.read()
+                if resp.status >= 300:
+                    raise Exception("HTTP %d" % resp.status)
+            except Exception as ex:
+                print(
+                    "Unable to publish Argo Event (%s): %s" % (event["body"]["name"], ex),
+                    file=sys.stderr,
+                )
+                if self.conn is not None:
+                    self.conn.close()
+                    self.conn = None
+                break
+            sent.append(event["key"])
+            print("Argo Event (%s) published." % event["body"]["name"], file=sys.stderr)
+        return sent
+
+
+def _parse_events(text):
+    return [json.loads(line) for line in text.splitlines() if line]
@@ -0,0 +1 @@
+../stats-profiler/origins.py
\ No newline at end of file
@@ -0,0 +1,36 @@
+import time
+from metaflow import FlowSpec, step
+
+from resourceprofiler import resource_profile
+
+class ResourceFlow(FlowSpec):
+
+    @resource_profile
+    @step
+    def start(self):
+        self.sizes = [10, 50, 100]
+        self.next(self.allocate, foreach='sizes')
+
+    @resource_profile
+    @step
+    def allocate(self):
+        print(f"🧱 Allocating {self.input}MB")
+        block = bytearray(self.input * 1024**2)
+        sum(range(5_000_000))
+        time.sleep(0.5)
+        self.allocated = len(block)
+        self.next(self.join)
+
+    @resource_profile
+    @step
+    def join(self, inputs):
+        self.total = sum(inp.allocated for inp in inputs)
+        self.next(self.end)
+
+    @resource_profile
+    @step
+    def end(self):
+        pass
+
+if __name__ == '__main__':
+    ResourceFlow()
@@ -0,0 +1,204 @@
+import gc
+import os
+import math
+import time
+import threading
+from metaflow import user_step_decorator, current
+
+from origins import distinct
+
+TICKS = os.sysconf("SC_CLK_TCK") if hasattr(os, "sysconf") else 100
+
+
+@user_step_decorator
+def resource_profile(step_name, flow, inputs=None, attributes=None):
+    sampler = ResourceSampler(
+        interval=float(attributes.get("interval_ms", 200)) / 1000,
+        max_samples=int(attributes.get("max_samples", 1000)),
+    )
+    sampler.start()
+    try:
+        yield
+    finally:
+        sampler.stop()
+    summary = sampler.summary()
+    flow.resource_series = sampler.series
+    flow.resource_summary = summary
+
+    if not hasattr(flow, "resource_usage"):
+        flow.resource_usage = {}
+    if inputs:
+        flow.resource_usage = merge_usage(
+            [inp.resource_usage for inp in inputs], current.pathspec
+        )
+    flow.resource_usage[step_name] = dict(
+        {key: summary[key] for key in PEAKS}, num_tasks=1, origin=current.pathspec
+    )
+    print(
+        f"📈 Task [{current.pathspec}] cpu {summary['avg_cpu']:.2f} cores "
+        f"(peak {summary['peak_cpu']:.2f}), peak rss {summary['peak_rss_mb']:.0f}MB, "
+        f"gc pauses {summary['gc_pause_ms']:.0f}ms"
+    )
+    if step_name == "end" and not attributes.get("silent"):
+        print_recommendations(flow.resource_usage)
+
+
+class ResourceSampler(object):
+    """
+    Samples CPU time, RSS, I/O and context switches of this process from
+    /proc in a daemon thread, and times GC pauses through gc.callbacks.
+    The series keeps at most `max_samples` points by halving its
+    resolution whenever it fills up.
+    """
+
+    def __init__(self, interval=0.2, max_samples=1000):
+        self.interval = interval
+        self.max_samples = max_samples
+        self.series = []
+        self.gc_pauses = []
+        self._gc_start = None
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        gc.callbacks.append(self._on_gc)
+        self.start_time = time.perf_counter()
+        self.first = self.last = read_proc()
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        gc.callbacks.remove(self._on_gc)
+        self._sample()
+
+    def _on_gc(self, phase, info):
+        if phase == "start":
+            self._gc_start = time.perf_counter()
+        elif self._gc_start is not None:
+            self.gc_pauses.append(time.perf_counter() - self._gc_start)
+            self._gc_start = None
+
+    def _run(self):
+        stride = 1
+        while not self._stop.wait(self.interval * stride):
+            self._sample()
+            if len(self.series) >= self.max_samples:
+                self.series = self.series[::2]
+                stride *= 2
+
+    def _sample(self):
+        now = read_proc()
+        elapsed = now["time"] - self.last["time"]
+        cpu = (now["cpu"] - self.last["cpu"]) / elapsed if elapsed > 0 else 0.0
+        self.series.append(
+            (
+                round(now["time"] - self.first["time"], 3),
+                round(cpu, 3),
+                round(now["rss"] / 1024**2, 1),
+                round((now["read"] - self.first["read"]) / 1024**2, 1),
+                round((now["write"] - self.first["write"]) / 1024**2, 1),
+            )
+        )
+        self.last = now
+
+    def summary(self):
+        first, last = self.first, self.last
+        duration = last["time"] - first["time"]
+        cpu_time = last["cpu"] - first["cpu"]
+        return {
+            "duration_s": duration,
+            "cpu_time_s": cpu_time,
+            "avg_cpu": cpu_time / duration if duration > 0 else 0.0,
+            "peak_cpu": max((s[1] for s in self.series), default=0.0),
+            "peak_rss_mb": max(last["peak_rss"], last["rss"]) / 1024**2,
+            "read_mb": (last["read"] - first["read"]) / 1024**2,
+            "write_mb": (last["write"] - first["write"]) / 1024**2,
+            "voluntary_ctx_switches": last["vcsw"] - first["vcsw"],
+            "involuntary_ctx_switches": last["ivcsw"] - first["ivcsw"],
+            "gc_collections": len(self.gc_pauses),
+            "gc_pause_ms": 1000 * sum(self.gc_pauses),
+            "gc_max_pause_ms": 1000 * max(self.gc_pauses, default=0.0),
+        }
+
+
+def read_proc():
+    sample = {"time": time.perf_counter()}
+    try:
+        with open("/proc/self/stat") as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+        sample["cpu"] = (int(fields[11]) + int(fields[12])) / TICKS
+        status = {}
+        with open("/proc/self/status") as f:
+            for line in f:
+                key, _, value = line.partition(":")
+                status[key] = value.split()
+        sample["rss"] = int(status["VmRSS"][0]) * 1024
+        sample["peak_rss"] = int(status["VmHWM"][0]) * 1024
+        sample["vcsw"] = int(status["voluntary_ctxt_switches"][0])
+        sample["ivcsw"] = int(status["nonvoluntary_ctxt_switches"][0])
+    except (OSError, KeyError, IndexError):
+        return read_rusage(sample)
+    try:
+        with open("/proc/self/io") as f:
+            io = dict(line.split(": ") for line in f.read().splitlines())
+        sample["read"], sample["write"] = int(io["read_bytes"]), int(io["write_bytes"])
+    except (OSError, KeyError, ValueError):
+        sample["read"] = sample["write"] = 0
+    return sample
+
+
+def read_rusage(sample):
+    # outside of Linux: coarser numbers from getrusage
+    import sys
+    import resource
+
+    ru = resource.getrusage(resource.RUSAGE_SELF)
+    maxrss = ru.ru_maxrss if sys.platform == "darwin" else ru.ru_maxrss * 1024
+    sample.update(
+        cpu=ru.ru_utime + ru.ru_stime,
+        rss=maxrss,
+        peak_rss=maxrss,
+        vcsw=ru.ru_nvcsw,
+        ivcsw=ru.ru_nivcsw,
+        read=ru.ru_inblock * 512,
+        write=ru.ru_oublock * 512,
+    )
+    return sample
+
+
+PEAKS = ("peak_cpu", "avg_cpu", "peak_rss_mb", "read_mb", "write_mb", "gc_pause_ms")
+
+
+def merge_usage(all_usage, origin):
+    """
+    Combine per-step peaks across the inputs of a join: the peak is the
+    largest seen by any task, and num_tasks counts each task once.
+    """
+    merged = {}
+    for step in dict.fromkeys(step for usage in all_usage for step in usage):
+        stats = distinct(usage[step] for usage in all_usage if step in usage)
+        if len(stats) == 1:
+            merged[step] = stats[0]
+        else:
+            merged[step] = {key: max(s[key] for s in stats) for key in PEAKS}
+            merged[step]["num_tasks"] = sum(s["num_tasks"] for s in stats)
+            merged[step]["origin"] = origin
+    return merged
+
+
+def recommend(stats, headroom=1.2):
+    cpu = max(1, math.ceil(stats["peak_cpu"] * headroom))
+    memory = max(512, 256 * math.ceil(stats["peak_rss_mb"] * headroom / 256))
+    return {"cpu": cpu, "memory": memory}
+
+
+def print_recommendations(all_usage):
+    print("📈 Observed peaks and suggested @resources")
+    print(f"{'Step':<20}{'Tasks':<8}{'Peak CPU':<10}{'Peak RSS (MB)':<15}{'Suggested':<30}")
+    for step, stats in all_usage.items():
+        rec = recommend(stats)
+        print(
+            f"{step:<20}{stats['num_tasks']:<8}{stats['peak_cpu']:<10.2f}"
+            f"{stats['peak_rss_mb']:<15.0f}@resources(cpu={rec['cpu']}, memory={rec['memory']})"
+        )
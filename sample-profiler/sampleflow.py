@@ -0,0 +1,24 @@
+import time
+from metaflow import FlowSpec, step
+
+from sampleprofiler import sample_profile
+
+def fib(n):
+    return n if n < 2 else fib(n - 1) + fib(n - 2)
+
+class SamplingFlow(FlowSpec):
+
+    @sample_profile(interval_ms=5, speedscope=True)
+    @step
+    def start(self):
+        for i in range(3):
+            time.sleep(0.2)
+            self.result = fib(24)
+        self.next(self.end)
+
+    @step
+    def end(self):
+        pass
+
+if __name__ == '__main__':
+    SamplingFlow()
@@ -0,0 +1,103 @@
+import os
+import sys
+import json
+import threading
+from collections import Counter
+from metaflow import user_step_decorator, current
+
+
+@user_step_decorator
+def sample_profile(step_name, flow, inputs=None, attributes=None):
+    interval = float(attributes.get("interval_ms", 10)) / 1000
+    sampler = StackSampler(threading.get_ident(), interval)
+    sampler.start()
+    try:
+        yield
+    finally:
+        sampler.stop()
+    flow.sample_profile = {
+        "interval_ms": interval * 1000,
+        "samples": dict(sampler.stacks),
+    }
+    print(f"🔥 Task [{current.pathspec}] collected {sum(sampler.stacks.values())} samples")
+    for stack, count in sampler.stacks.most_common(int(attributes.get("top", 5))):
+        print(f"{count:>8}  {stack.rsplit(';', 1)[-1]}")
+    speedscope = attributes.get("speedscope")
+    if speedscope:
+        path = speedscope if isinstance(speedscope, str) else "."
+        path = os.path.join(path, f"{current.flow_name}-{step_name}-{current.task_id}.speedscope.json")
+        with open(path, "w") as f:
+            json.dump(to_speedscope(flow.sample_profile, current.pathspec), f)
+        print(f"🔥 Speedscope profile written to {path}")
+
+
+class StackSampler(object):
+    """
+    Samples the stack of one thread from a daemon thread and counts the
+    collapsed stacks, "outer;...;inner" with frames as "func (file:line)".
+    """
+
+    def __init__(self, thread_id, interval):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._codes = {}
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            frames = []
+            while frame is not None:
+                frames.append(self._label(frame.f_code))
+                frame = frame.f_back
+            self.stacks[";".join(reversed(frames))] += 1
+
+    def _label(self, code):
+        label = self._codes.get(code)
+        if label is None:
+            label = "%s (%s:%d)" % (
+                code.co_name,
+                os.path.basename(code.co_filename),
+                code.co_firstlineno,
+            )
+            self._codes[code] = label
+        return label
+
+
+def to_speedscope(profile, name="profile"):
+    frames, index = [], {}
+    samples, weights = [], []
+    for stack, count in profile["samples"].items():
+        sample = []
+        for label in stack.split(";"):
+            if label not in index:
+                index[label] = len(frames)
+                frames.append({"name": label})
+            sample.append(index[label])
+        samples.append(sample)
+        weights.append(count * profile["interval_ms"])
+    return {
+        "$schema": "https://www.speedscope.app/file-format-schema.json",
+        "shared": {"frames": frames},
+        "profiles": [
+            {
+                "type": "sampled",
+                "name": name,
+                "unit": "milliseconds",
+                "startValue": 0,
+                "endValue": sum(weights),
+                "samples": samples,
+                "weights": weights,
+            }
+        ],
+        "exporter": "sample_profile",
+    }
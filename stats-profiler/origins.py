@@ -0,0 +1,7 @@
+def distinct(records):
+    """
+    Keep one copy of each per-step record carried into a join. A record
+    produced upstream of the split reaches the join once per input; its
+    `origin` (the task that produced it) identifies the copies.
+    """
+    return list({record["origin"]: record for record in records}.values())
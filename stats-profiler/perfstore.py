@@ -0,0 +1,226 @@
+import os
+import sys
+import time
+import hashlib
+
+PERF_STORE = os.environ.get(
+    "PERF_STORE", os.path.join(os.path.expanduser("~"), ".metaflow_perf", "perf.db")
+)
+# fewest values a comparison is made with, on either side
+MIN_SAMPLES = 3
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS metrics (
+    flow TEXT NOT NULL,
+    run_id TEXT NOT NULL,
+    step TEXT NOT NULL,
+    task_id TEXT NOT NULL,
+    metric TEXT NOT NULL,
+    value REAL NOT NULL,
+    code_version TEXT,
+    created REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS metrics_flow_run ON metrics (flow, run_id);
+"""
+
+
+class PerfStore(object):
+    """
+    Appends per-task metrics of profiled runs to a local SQLite database
+    and compares the latest run of a flow against the runs before it.
+    """
+
+    def __init__(self, path=PERF_STORE):
+        import sqlite3
+
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.db = sqlite3.connect(path, timeout=60, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.executescript(SCHEMA)
+
+    def record(self, flow, step_name, metrics):
+        from metaflow import current
+
+        now = time.time()
+        version = code_version(flow)
+        self.db.executemany(
+            "INSERT INTO metrics VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            [
+                (
+                    current.flow_name,
+                    current.run_id,
+                    step_name,
+                    current.task_id,
+                    metric,
+                    float(value),
+                    version,
+                    now,
+                )
+                for metric, value in metrics.items()
+            ],
+        )
+
+    def runs(self, flow_name):
+        return [
+            run_id
+            for run_id, in self.db.execute(
+                "SELECT run_id FROM metrics WHERE flow=? "
+                "GROUP BY run_id ORDER BY MIN(created) DESC",
+                (flow_name,),
+            )
+        ]
+
+    def samples(self, flow_name, run_ids):
+        # values of each (step, metric), per run
+        samples = {}
+        marks = ", ".join("?" for _ in run_ids)
+        for run_id, step, metric, value in self.db.execute(
+            "SELECT run_id, step, metric, value FROM metrics "
+            f"WHERE flow=? AND run_id IN ({marks})",
+            [flow_name] + list(run_ids),
+        ):
+            samples.setdefault((step, metric), {}).setdefault(run_id, []).append(value)
+        return samples
+
+    def compare(self, flow_name, baseline_runs=10, alpha=0.01, threshold=1.1):
+        """
+        Compare each step's metrics in the latest run against the runs
+        before it. Foreach steps with enough tasks are tested against all
+        baseline tasks with Mann-Whitney U. Steps with one or two tasks
+        can never reach a small p that way, so their median is scored
+        against the spread of the baseline runs' medians instead. Either
+        way fewer than MIN_SAMPLES baseline values is insufficient data.
+        """
+        from statistics import median
+
+        runs = self.runs(flow_name)
+        if len(runs) < 2:
+            return runs[:1], []
+        latest = self.samples(flow_name, runs[:1])
+        baseline = self.samples(flow_name, runs[1 : baseline_runs + 1])
+        results = []
+        for key, by_run in sorted(latest.items()):
+            values = [v for run in by_run.values() for v in run]
+            base_runs = baseline.get(key, {})
+            base = [v for run in base_runs.values() for v in run]
+            if len(values) >= MIN_SAMPLES:
+                test, enough = "mann-whitney", len(base) >= MIN_SAMPLES
+            else:
+                base = [median(run) for run in base_runs.values()]
+                test, enough = "robust-z", len(base) >= MIN_SAMPLES
+            result = {
+                "step": key[0],
+                "metric": key[1],
+                "latest": median(values),
+                "baseline": median(base) if base else None,
+                "ratio": None,
+                "p_value": None,
+                "test": test if enough else "insufficient data",
+                "regression": False,
+            }
+            if enough:
+                result["ratio"] = (
+                    median(values) / median(base) if median(base) else float("inf")
+                )
+                if test == "mann-whitney":
+                    result["p_value"] = slower_p_value(values, base)
+                else:
+                    result["p_value"] = robust_p_value(median(values), base)
+                result["regression"] = (
+                    result["p_value"] < alpha and result["ratio"] >= threshold
+                )
+            results.append(result)
+        return runs[: baseline_runs + 1], results
+
+
+def code_version(flow):
+    # hash of the flow's source file, so runs of edited code are told apart
+    module = sys.modules.get(type(flow).__module__)
+    try:
+        with open(module.__file__, "rb") as f:
+            return hashlib.sha1(f.read()).hexdigest()[:12]
+    except (AttributeError, OSError):
+        return None
+
+
+def slower_p_value(sample, baseline):
+    """
+    One-sided Mann-Whitney U test that `sample` tends to be larger than
+    `baseline`, using the normal approximation with a tie correction.
+    """
+    n1, n2 = len(sample), len(baseline)
+    ranked = sorted([(v, 0) for v in sample] + [(v, 1) for v in baseline])
+    ranks, ties, i = [0.0] * len(ranked), 0.0, 0
+    while i < len(ranked):
+        j = i
+        while j + 1 < len(ranked) and ranked[j + 1][0] == ranked[i][0]:
+            j += 1
+        for k in range(i, j + 1):
+            ranks[k] = (i + j) / 2 + 1
+        t = j - i + 1
+        ties += t**3 - t
+        i = j + 1
+    r1 = sum(rank for rank, (_v, group) in zip(ranks, ranked) if group == 0)
+    u = r1 - n1 * (n1 + 1) / 2
+    n = n1 + n2
+    var = n1 * n2 / 12 * ((n + 1) - ties / (n * (n - 1)))
+    if var <= 0:
+        return 1.0
+    z = (u - n1 * n2 / 2 - 0.5) / var**0.5
+    from statistics import NormalDist
+
+    return 1 - NormalDist().cdf(z)
+
+
+def robust_p_value(value, baseline):
+    """
+    One-sided p that `value` is larger than the `baseline` values, from
+    its robust z-score: the distance from their median in units of the
+    median absolute deviation, scaled to a normal standard deviation.
+    """
+    from statistics import NormalDist, median
+
+    center = median(baseline)
+    mad = 1.4826 * median(abs(v - center) for v in baseline)
+    if mad == 0:
+        return 0.0 if value > center else 1.0
+    return 1 - NormalDist().cdf((value - center) / mad)
+
+
+def _fmt(value, spec):
+    return "-" if value is None else format(value, spec)
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Compare profiled runs of a flow")
+    parser.add_argument("command", choices=["compare"])
+    parser.add_argument("flow")
+    parser.add_argument("--store", default=PERF_STORE)
+    parser.add_argument("--runs", type=int, default=10, help="baseline runs")
+    parser.add_argument("--alpha", type=float, default=0.01)
+    parser.add_argument("--threshold", type=float, default=1.1, help="minimum slowdown ratio")
+    args = parser.parse_args()
+
+    runs, results = PerfStore(args.store).compare(
+        args.flow, args.runs, args.alpha, args.threshold
+    )
+    if len(runs) < 2:
+        print(f"Need at least two recorded runs of {args.flow}")
+        return 0
+    print(f"📊 {args.flow}: run {runs[0]} vs {len(runs) - 1} baseline runs")
+    print(
+        f"{'Step':<20}{'Metric':<30}{'Latest':<12}{'Baseline':<12}{'Ratio':<8}{'p':<8}{'Test':<20}"
+    )
+    for r in results:
+        flag = "🐢 " if r["regression"] else ""
+        print(
+            f"{r['step']:<20}{r['metric']:<30}{r['latest']:<12.1f}{_fmt(r['baseline'], '.1f'):<12}"
+            f"{_fmt(r['ratio'], '.2f'):<8}{_fmt(r['p_value'], '.3f'):<8}{r['test']:<20}{flag}"
+        )
+    return 1 if any(r["regression"] for r in results) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
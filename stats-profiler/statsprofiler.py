@@ -1,31 +1,108 @@
+import math
 import time
-import json
-from metaflow import user_step_decorator
-from collections import defaultdict
+from metaflow import user_step_decorator, current
+
+from origins import distinct
+from perfstore import PerfStore
+
+# relative accuracy of the reported percentiles
+ALPHA = 0.01
+GAMMA = (1 + ALPHA) / (1 - ALPHA)
+LOG_GAMMA = math.log(GAMMA)
+# durations below this (in ms) are counted in a single zero bucket
+MIN_VALUE = 1e-3
 
 @user_step_decorator
 def stats_profile(step_name, flow, inputs=None, attributes=None):
-    start = time.time()
+    start = time.perf_counter()
+    cpu_start = time.process_time()
     yield
-    duration = int(1000 * (time.time() - start))
+    duration = 1000 * (time.perf_counter() - start)
+    cpu = 1000 * (time.process_time() - cpu_start)
 
     if not hasattr(flow, "timings"):
-        flow.timings = defaultdict(list)
+        flow.timings = {}
     if inputs:
-        for inp in inputs:
-            for step, timings in inp.timings.items():
-                flow.timings[step].extend(timings)
-    flow.timings[step_name].append(duration)
+        flow.timings = merge_timings([inp.timings for inp in inputs], current.pathspec)
+    timings = flow.timings.setdefault(step_name, {"wall": sketch(), "cpu": sketch()})
+    for kind, value in (("wall", duration), ("cpu", cpu)):
+        add(timings[kind], value)
+        timings[kind]["origin"] = current.pathspec
+    store = attributes.get("store")
+    if store:
+        PerfStore(*([store] if isinstance(store, str) else [])).record(
+            flow, step_name, {"wall_ms": duration, "cpu_ms": cpu}
+        )
     if step_name == "end" and not attributes.get("silent"):
         print_results(flow.timings)
 
+def sketch():
+    """
+    A DDSketch-style quantile sketch: values are counted in logarithmic
+    buckets, so any quantile is within ALPHA of the true value and two
+    sketches merge by adding bucket counts. `origin` is the task that last
+    changed the sketch, which lets joins skip copies shared by all inputs.
+    """
+    return {"count": 0, "sum": 0.0, "min": None, "max": None, "zeros": 0, "bins": {}, "origin": None}
+
+def add(sk, value):
+    sk["count"] += 1
+    sk["sum"] += value
+    sk["min"] = value if sk["min"] is None else min(sk["min"], value)
+    sk["max"] = value if sk["max"] is None else max(sk["max"], value)
+    if value < MIN_VALUE:
+        sk["zeros"] += 1
+    else:
+        idx = math.ceil(math.log(value) / LOG_GAMMA)
+        sk["bins"][idx] = sk["bins"].get(idx, 0) + 1
+
+def merge(sketches, origin):
+    merged = sketch()
+    for sk in sketches:
+        merged["count"] += sk["count"]
+        merged["sum"] += sk["sum"]
+        merged["zeros"] += sk["zeros"]
+        for bound, pick in (("min", min), ("max", max)):
+            if sk[bound] is not None:
+                merged[bound] = sk[bound] if merged[bound] is None else pick(merged[bound], sk[bound])
+        for idx, n in sk["bins"].items():
+            merged["bins"][idx] = merged["bins"].get(idx, 0) + n
+    merged["origin"] = origin
+    return merged
+
+def merge_timings(all_timings, origin):
+    merged = {}
+    for step in dict.fromkeys(step for timings in all_timings for step in timings):
+        for kind in ("wall", "cpu"):
+            # adding a shared sketch twice would double its counts
+            sketches = distinct(t[step][kind] for t in all_timings if step in t)
+            merged.setdefault(step, {})[kind] = (
+                sketches[0] if len(sketches) == 1 else merge(sketches, origin)
+            )
+    return merged
+
+def quantile(sk, q):
+    rank = q * (sk["count"] - 1)
+    seen = sk["zeros"]
+    if rank < seen:
+        return sk["min"]
+    for idx in sorted(sk["bins"]):
+        seen += sk["bins"][idx]
+        if rank < seen:
+            value = 2 * GAMMA ** idx / (GAMMA + 1)
+            return min(max(value, sk["min"]), sk["max"])
+    return sk["max"]
+
 def print_results(all_timings):
     print("📊 Step timings")
-    print(f"{'Step':<20}{'P10 (ms)':<15}{'Median (ms)':<15}{'P90 (ms)':<15}")
+    print(
+        f"{'Step':<20}{'Tasks':<8}{'P10 (ms)':<12}{'Median (ms)':<14}"
+        f"{'P90 (ms)':<12}{'P99 (ms)':<12}{'CPU median (ms)':<16}"
+    )
     for step, timings in all_timings.items():
-        timings.sort()
-        n = len(timings)
-        p10 = timings[int(n * 0.1)]
-        median = timings[n // 2]
-        p90 = timings[int(n * 0.9)]
-        print(f"{step:<20}{p10:<15}{median:<15}{p90:<15}")
+        wall, cpu = timings["wall"], timings["cpu"]
+        p10, median, p90, p99 = (quantile(wall, q) for q in (0.1, 0.5, 0.9, 0.99))
+        print(
+            f"{step:<20}{wall['count']:<8}{p10:<12.1f}{median:<14.1f}"
+            f"{p90:<12.1f}{p99:<12.1f}{quantile(cpu, 0.5):<16.1f}"
+        )
@@ -0,0 +1,195 @@
+import os
+import json
+import time
+import queue
+import random
+import hashlib
+import threading
+import urllib.request
+
+OTLP_ENDPOINT = os.environ.get("OTEL_EXPORTER_OTLP_ENDPOINT")
+OTLP_FILE = os.environ.get("OTEL_TRACES_FILE")
+
+_exporter = None
+# put on the queue by flush() to send the batch being collected right away
+_FLUSH = object()
+_exporter_lock = threading.Lock()
+
+
+def get_exporter(endpoint=None, path=None):
+    """
+    Return the process-wide exporter, created on first use. Spans are sent
+    as OTLP/JSON to `endpoint` (.../v1/traces is appended) or appended to
+    the file at `path`, one export request per line.
+    """
+    global _exporter
+    with _exporter_lock:
+        if _exporter is None:
+            _exporter = SpanExporter(endpoint or OTLP_ENDPOINT, path or OTLP_FILE)
+        return _exporter
+
+
+class SpanExporter(object):
+    """
+    Batches spans in a background thread. export() never blocks: when the
+    bounded queue is full the span is dropped and counted in `dropped`.
+    """
+
+    def __init__(
+        self, endpoint=None, path=None, max_queue=4096, batch_size=512, interval=1.0, timeout=5
+    ):
+        if endpoint and not endpoint.rstrip("/").endswith("/v1/traces"):
+            endpoint = endpoint.rstrip("/") + "/v1/traces"
+        self.endpoint = endpoint
+        self.path = path
+        self.batch_size = batch_size
+        self.interval = interval
+        self.timeout = timeout
+        self.queue = queue.Queue(max_queue)
+        self.dropped = 0
+        self.failed = 0
+        self.exported = 0
+        self._flushed = threading.Condition()
+        self._pending = 0
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def export(self, span):
+        # count the span before the sender can see it, so that its
+        # decrement never runs first and lets flush() return early
+        with self._flushed:
+            self._pending += 1
+        try:
+            self.queue.put_nowait(span)
+        except queue.Full:
+            with self._flushed:
+                self._pending -= 1
+                self._flushed.notify_all()
+            self.dropped += 1
+
+    def flush(self, timeout=2.0):
+        """
+        Wait up to `timeout` seconds for queued spans to be sent.
+        """
+        deadline = time.monotonic() + timeout
+        with self._flushed:
+            if self._pending:
+                try:
+                    self.queue.put_nowait(_FLUSH)
+                except queue.Full:
+                    # a full queue fills a batch without waiting anyway
+                    pass
+            while self._pending:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._flushed.wait(remaining)
+        return True
+
+    def _run(self):
+        while True:
+            span = self.queue.get()
+            if span is _FLUSH:
+                continue
+            batch = [span]
+            deadline = time.monotonic() + self.interval
+            while len(batch) < self.batch_size:
+                try:
+                    span = self.queue.get(timeout=max(0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if span is _FLUSH:
+                    break
+                batch.append(span)
+            try:
+                self._send(batch)
+                self.exported += len(batch)
+            except Exception:
+                self.failed += len(batch)
+            with self._flushed:
+                self._pending -= len(batch)
+                self._flushed.notify_all()
+
+    def _send(self, batch):
+        body = json.dumps(otlp_request(batch)).encode("utf-8")
+        if self.path:
+            with open(self.path, "ab") as f:
+                f.write(body + b"\n")
+        if self.endpoint:
+            req = urllib.request.Request(
+                self.endpoint, data=body, headers={"Content-Type": "application/json"}
+            )
+            urllib.request.urlopen(req, timeout=self.timeout).close()
+
+
+def otlp_request(spans):
+    return {
+        "resourceSpans": [
+            {
+                "resource": {"attributes": otlp_attributes({"service.name": "metaflow"})},
+                "scopeSpans": [{"scope": {"name": "metaflow.profilers"}, "spans": spans}],
+            }
+        ]
+    }
+
+
+def otlp_attributes(attrs):
+    def _value(v):
+        if isinstance(v, bool):
+            return {"boolValue": v}
+        if isinstance(v, int):
+            return {"intValue": str(v)}
+        if isinstance(v, float):
+            return {"doubleValue": v}
+        return {"stringValue": str(v)}
+
+    return [{"key": k, "value": _value(v)} for k, v in attrs.items() if v is not None]
+
+
+def make_span(name, trace_id, span_id, parent_id, start_ns, end_ns, attrs=None):
+    span = {
+        "traceId": trace_id,
+        "spanId": span_id,
+        "name": name,
+        "kind": 1,
+        "startTimeUnixNano": str(start_ns),
+        "endTimeUnixNano": str(end_ns),
+        "attributes": otlp_attributes(attrs or {}),
+    }
+    if parent_id:
+        span["parentSpanId"] = parent_id
+    return span
+
+
+def _hex_id(text, length):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()[:length]
+
+
+def new_span_id():
+    return "%016x" % random.getrandbits(64)
+
+
+def task_context(flow):
+    """
+    Ids and attributes of the running task's span: all tasks of a run
+    share the run's trace id, and task span ids are derived from the
+    pathspec so child spans can be parented without coordination.
+    """
+    from metaflow import current
+
+    try:
+        index = flow.index
+    except Exception:
+        index = None
+    trace_id = _hex_id(f"{current.flow_name}/{current.run_id}", 32)
+    span_id = _hex_id(f"{current.pathspec}/{current.retry_count}", 16)
+    attrs = {
+        "metaflow.flow_name": current.flow_name,
+        "metaflow.run_id": current.run_id,
+        "metaflow.step_name": current.step_name,
+        "metaflow.task_id": current.task_id,
+        "metaflow.pathspec": current.pathspec,
+        "metaflow.retry_count": current.retry_count,
+        "metaflow.foreach_index": index,
+    }
+    return trace_id, span_id, attrs
@@ -0,0 +1 @@
+../stats-profiler/perfstore.py
\ No newline at end of file
@@ -1,26 +1,199 @@
-import time
+import threading
+import contextvars
+from time import perf_counter_ns, time_ns
 from metaflow import user_step_decorator
-from collections import defaultdict
+
+from perfstore import PerfStore
+from otelexport import get_exporter, make_span, new_span_id, task_context
+
+# the collector of the running task and the innermost open span, per
+# thread and per asyncio task
+_collector = contextvars.ContextVar("trace_collector", default=None)
+_parent = contextvars.ContextVar("trace_parent", default=None)
 
 @user_step_decorator
 def trace_profile(step_name, flow, inputs=None, attributes=None):
-    flow.trace = TraceCollector
-    yield
-    del flow.trace
-    flow.timings = TraceCollector.timings
-    for name, timings in TraceCollector.timings.items():
-        print(f"Trace: {name} - Total: {int(timings)}ms")
+    exporter = trace_id = task_span = None
+    if attributes.get("export"):
+        exporter = get_exporter(attributes.get("endpoint"), attributes.get("path"))
+        trace_id, task_span, task_attrs = task_context(flow)
+    collector = TraceCollector(
+        enabled=not attributes.get("disabled"),
+        exporter=exporter,
+        trace_id=trace_id,
+        root_id=task_span,
+    )
+    token = _collector.set(collector)
+    flow.trace = collector
+    start_ns = time_ns()
+    try:
+        yield
+    finally:
+        _collector.reset(token)
+        del flow.trace
+        if exporter:
+            exporter.export(
+                make_span(step_name, trace_id, task_span, None, start_ns, time_ns(), task_attrs)
+            )
+            exporter.flush(float(attributes.get("flush_timeout", 2)))
+            if exporter.dropped:
+                print(f"⚠️  {exporter.dropped} spans dropped under backpressure")
+    flow.timings = collector.totals()
+    flow.trace_stats = collector.summary()
+    for name, stats in flow.trace_stats.items():
+        print(
+            f"Trace: {name} - Total: {int(stats['total_ms'])}ms "
+            f"(n={stats['count']}, min={stats['min_ms']:.2f}ms, max={stats['max_ms']:.2f}ms)"
+        )
+    store = attributes.get("store")
+    if store:
+        PerfStore(*([store] if isinstance(store, str) else [])).record(
+            flow, step_name, {f"span:{name}": ms for name, ms in flow.timings.items()}
+        )
+
+def trace(name):
+    """
+    Open a span on the current task's collector, for code that doesn't
+    have access to `self.trace`. A no-op outside of @trace_profile.
+    """
+    collector = _collector.get()
+    return collector(name) if collector else NOOP
 
 class TraceCollector(object):
 
-    timings = defaultdict(int)
+    def __init__(self, enabled=True, exporter=None, trace_id=None, root_id=None):
+        self.enabled = enabled
+        self.exporter = exporter
+        self.trace_id = trace_id
+        self.root_id = root_id
+        # converts perf_counter_ns readings to wall-clock time for export
+        self.anchor = time_ns() - perf_counter_ns()
+        # each thread records into its own shard, so recording takes no
+        # lock: span path -> [count, total_ns, min_ns, max_ns, log2 histogram]
+        self.local = threading.local()
+        self.shards = []
+        self.lock = threading.Lock()
+
+    def __call__(self, name):
+        if not self.enabled:
+            return NOOP
+        return Span(self, name)
+
+    def record(self, path, duration):
+        try:
+            shard = self.local.stats
+        except AttributeError:
+            shard = self.local.stats = {}
+            with self.lock:
+                self.shards.append(shard)
+        stats = shard.get(path)
+        if stats is None:
+            stats = shard[path] = [0, 0, duration, duration, [0] * 64]
+        stats[0] += 1
+        stats[1] += duration
+        if duration < stats[2]:
+            stats[2] = duration
+        if duration > stats[3]:
+            stats[3] = duration
+        stats[4][min(duration.bit_length(), 63)] += 1
+
+    def emit(self, span, duration):
+        start = self.anchor + span.start
+        self.exporter.export(
+            make_span(
+                span.name,
+                self.trace_id,
+                span.span_id,
+                span.parent_id,
+                start,
+                start + duration,
+                {"trace.path": span.path},
+            )
+        )
+
+    def merged(self):
+        merged = {}
+        with self.lock:
+            shards = list(self.shards)
+        for shard in shards:
+            for path, (count, total, lo, hi, buckets) in list(shard.items()):
+                stats = merged.get(path)
+                if stats is None:
+                    merged[path] = [count, total, lo, hi, list(buckets)]
+                else:
+                    stats[0] += count
+                    stats[1] += total
+                    stats[2] = min(stats[2], lo)
+                    stats[3] = max(stats[3], hi)
+                    stats[4] = [a + b for a, b in zip(stats[4], buckets)]
+        return merged
+
+    def totals(self):
+        return {path: stats[1] / 1e6 for path, stats in self.merged().items()}
+
+    def summary(self):
+        return {
+            path: {
+                "count": count,
+                "total_ms": total / 1e6,
+                "mean_ms": total / count / 1e6,
+                "min_ms": lo / 1e6,
+                "max_ms": hi / 1e6,
+                # upper bound of each bucket in ms -> count
+                "histogram": {(1 << i) / 1e6: n for i, n in enumerate(buckets) if n},
+            }
+            for path, (count, total, lo, hi, buckets) in self.merged().items()
+        }
+
+class Span(object):
+    """
+    A timed block, nested under the span that is open when it's entered.
+    Works as both a regular and an async context manager.
+    """
+
+    __slots__ = ("collector", "name", "path", "start", "token", "span_id", "parent_id")
 
-    def __init__(self, name):
+    def __init__(self, collector, name):
+        self.collector = collector
         self.name = name
 
     def __enter__(self):
-        self.start = time.time()
+        parent = _parent.get()
+        self.path = self.name if parent is None else f"{parent.path}/{self.name}"
+        if self.collector.exporter is not None:
+            self.span_id = new_span_id()
+            self.parent_id = self.collector.root_id if parent is None else parent.span_id
+        self.token = _parent.set(self)
+        self.start = perf_counter_ns()
+        return self
 
     def __exit__(self, type, value, traceback):
-        self.timings[self.name] += 1000 * (time.time() - self.start)
+        duration = perf_counter_ns() - self.start
+        _parent.reset(self.token)
+        self.collector.record(self.path, duration)
+        if self.collector.exporter is not None:
+            self.collector.emit(self, duration)
+
+    async def __aenter__(self):
+        return self.__enter__()
+
+    async def __aexit__(self, type, value, traceback):
+        self.__exit__(type, value, traceback)
+
+class NoopSpan(object):
+
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        pass
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, type, value, traceback):
+        pass
 
+NOOP = NoopSpan()